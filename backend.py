@@ -13,13 +13,120 @@ file, you can obtain one at https://mozilla.org/MPL/2.0/
 '''
 
 
+import argparse
+import hashlib
+import ijson
+import io
+import json
+import numpy as np
+import os
 import requests
+import service
 import sqlite3
+import sys
+import time
+import tracing
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from itertools import islice
+from PIL import Image
+from store import STATS, describe
 
 API_URL = 'https://restcountries.com/v3.1/all'
+API_TIMEOUT = 30       # seconds, for each connect and read
 DATABASE = 'countries.db'
 
+# Offline data: JSON snapshot of the API response, and directory of flag
+# .png files named by content hash, with an index from flag URL to hash
+SNAPSHOT = 'countries.json'
+FLAG_DIR = 'flags'
 
+# Every refresh is built in a copy of the DB with suffix BUILDING, renamed
+# with suffix BUILT once complete, then swapped in for the DB, so readers 
+# only ever see a finished DB
+BUILDING = '.building'
+BUILT = '.new'
+# Held locked by the one process building; the OS releases it if that 
+# process dies, so a crash never leaves the DB unable to refresh
+LOCK = '.lock'
+
+# Skip the refresh entirely if the DB was checked against the API recently
+REFRESH_TTL = 24 * 60 * 60     # seconds
+
+# Flag downloads: about 250 small images, fetched concurrently over one 
+# keep-alive session instead of one fresh connection per country
+FLAG_WORKERS = 16      # number of concurrent downloads
+FLAG_TIMEOUT = 10      # seconds, for each connect and read
+FLAG_RETRIES = 3       # attempts per flag before giving up
+FLAG_BACKOFF = 0.5     # seconds, doubled after every failed attempt
+
+# Countries are parsed from the response as it arrives and written this
+# many at a time, so memory use doesn't grow with the size of the response
+BATCH_SIZE = 500
+READ_SIZE = 64 * 1024  # bytes
+
+# Size of flag thumbnail on country cards, made once at ingest
+THUMB_SIZE = (40, 30)
+
+# Placeholder for countries with no capital, currency, or language
+NO_VAL = ['None']
+
+# Settings for the build: the DB can always be rebuilt from the API,
+# so trade durability against power loss for speed
+BUILD_PRAGMAS = ['synchronous = OFF', 'temp_store = MEMORY', 
+                 'cache_size = -65536']
+
+# Columns written for each table, in insertion order
+TABLE_COLUMNS = {
+    'Continents' : ('id', 'name'),
+    'Flags' : ('id', 'hash', 'image', 'thumb'),
+    'Countries' : ('id', 'name', 'official', 'code', 'indep', 'mflag', 
+                   'flag', 'continent', 'area', 'population', 'map', 
+                   'hash'),
+    'Capitals' : ('id', 'name'),
+    'Languages' : ('id', 'name'),
+    'Currencies' : ('id', 'name'),
+    'Count_Cap_Jn' : ('country', 'capital'),
+    'Count_Lang_Jn' : ('country', 'language'),
+    'Count_Curr_Jn' : ('country', 'currency'),
+    'BorderStage' : ('country', 'code'),
+    }
+
+# Borders name the neighbor by code, which may not have an id yet
+# They are staged here and resolved by writeBorders once all countries are in
+STAGE_BORDERS = '''CREATE TEMP TABLE IF NOT EXISTS BorderStage(
+    country INTEGER,
+    code TEXT)'''
+
+# Checkpoints of a build, kept in the build file until it is finished, so
+# a build that fails partway can be resumed: schema version and full 
+# rebuild or not when it began, and batches written so far
+PROGRESS = '''CREATE TABLE IF NOT EXISTS Progress(
+    key TEXT PRIMARY KEY,
+    value)'''
+
+# Metrics summarized in the Aggregates table; density is people per km²
+AGGREGATE_METRICS = ['area', 'population', 'density']
+
+# Schema version recorded in PRAGMA user_version
+# createTables builds version 1, MIGRATIONS bring it up to SCHEMA_VERSION
+SCHEMA_VERSION = 8
+
+# Lookup tables whose ids are assigned while walking the JSON
+LOOKUP_TABLES = ['Continents', 'Capitals', 'Languages', 'Currencies']
+
+# Key in parsed country, lookup table, junction table
+JUNCTIONS = [('caps', 'Capitals', 'Count_Cap_Jn'),
+             ('langs', 'Languages', 'Count_Lang_Jn'),
+             ('currens', 'Currencies', 'Count_Curr_Jn')]
+
+# Column in each junction table that refers to the lookup table
+JUNCTION_COLUMNS = {'Count_Cap_Jn' : 'capital', 
+                    'Count_Lang_Jn' : 'language',
+                    'Count_Curr_Jn' : 'currency'}
+
+
+@tracing.traced
 def createTables(cur) :  
     '''Download data from API and create database tables'''
     # Create Continents table, many countries in a continent
@@ -42,7 +149,8 @@ def createTables(cur) :
         continent INTEGER NOT NULL,
         area INTEGER NOT NULL,
         population INTEGER NOT NULL,
-        map TEXT NOT NULL UNIQUE)''')
+        map TEXT NOT NULL UNIQUE,
+        hash TEXT NOT NULL)''')
     
     # Create Capitals table, one country can have many capitals (South Africa)
     # One capital can serve many countries (Jerusalem for Israel and Palestine)
@@ -94,140 +202,1255 @@ def createTables(cur) :
         country_1 INTEGER,
         country_2 INTEGER)''')
     
+    # Create Meta table, API validators and time of last check
+    cur.execute('DROP TABLE IF EXISTS Meta')
+    cur.execute('''CREATE TABLE Meta(
+        key TEXT NOT NULL PRIMARY KEY,
+        value TEXT)''')
+    
+    # Tables added by migrations are dropped too, for migrate to rebuild
+    cur.execute('DROP TABLE IF EXISTS Search')
+    cur.execute('DROP TABLE IF EXISTS Aggregates')
+    cur.execute('DROP TABLE IF EXISTS Flags')
+    
+    cur.execute('PRAGMA user_version = 1')
+    
 
-def writeTables (countries, cur) :
-    '''Write data from database into tables'''
-    # Can't put country into borders table if it isn't in countries table
-    # But the countries bordering a given country might not already be there
-    # Local dictionary to solve this chicken-and-egg problem
-    borders_dict = {}
-        
-    # Walk through JSON and populate database
-    for val in countries :
-        country = val['name']['common']
-         
-        # Prepare to handle special cases before attempting to write tables
-        # Or writing will crash / tables will have wrong data
+def addIndexes(cur) :
+    '''
+    Schema version 2: indexes for every query the front end runs
+    Composite indexes put the filter column first and the sort or 
+    returned column next, so lookups never read the table itself
+    '''
+    # Countries listed by continent, sorted by name, area, or population
+    cur.execute('''CREATE INDEX IF NOT EXISTS Countries_cont_name 
+                ON Countries (continent, name)''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS Countries_cont_area 
+                ON Countries (continent, area, name)''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS Countries_cont_pop 
+                ON Countries (continent, population, name)''')
+    
+    # Countries worldwide sorted by area or population
+    cur.execute('''CREATE INDEX IF NOT EXISTS Countries_area 
+                ON Countries (area, name)''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS Countries_pop 
+                ON Countries (population, name)''')
+    
+    # Junction tables are searched from both sides
+    for _, table, junction in JUNCTIONS :
+        col = JUNCTION_COLUMNS[junction]
+        cur.execute(f'''CREATE INDEX IF NOT EXISTS {junction}_country 
+                    ON {junction} (country, {col})''')
+        cur.execute(f'''CREATE INDEX IF NOT EXISTS {junction}_{col} 
+                    ON {junction} ({col}, country)''')
+    
+    cur.execute('''CREATE INDEX IF NOT EXISTS Borders_country_1 
+                ON Borders (country_1, country_2)''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS Borders_country_2 
+                ON Borders (country_2, country_1)''')
+    
     
+def addThumbnails(cur) :
+    '''Schema version 3: flag thumbnail stored next to the full image'''
+    cur.execute('ALTER TABLE Countries ADD COLUMN thumb BLOB')
+    thumbs = Thumbnails()
+    cur.executemany('UPDATE Countries SET thumb = ? WHERE id = ?', 
+                    [(thumbs.make(wflag), cid) for cid, wflag in 
+                     cur.execute('SELECT id, wflag FROM Countries').fetchall()])
+    
+    
+def pairBorders(cur) :
+    '''
+    Schema version 4: each land border stored once, as an unordered pair
+    The lower country id always goes in country_1, so the UNIQUE constraint
+    catches a border listed from both sides. Its index serves lookups by
+    country_1, and Borders_country_2 serves lookups from the other side
+    '''
+    cur.execute('''CREATE TABLE Borders_v4(
+        id INTEGER NOT NULL PRIMARY KEY UNIQUE,
+        country_1 INTEGER NOT NULL,
+        country_2 INTEGER NOT NULL,
+        CHECK (country_1 < country_2),
+        UNIQUE (country_1, country_2) ON CONFLICT IGNORE)''')
+    cur.execute('''INSERT INTO Borders_v4 (country_1, country_2)
+                SELECT MIN(country_1, country_2), MAX(country_1, country_2)
+                FROM Borders WHERE country_1 != country_2''')
+    cur.execute('DROP TABLE Borders')
+    cur.execute('ALTER TABLE Borders_v4 RENAME TO Borders')
+    cur.execute('''CREATE INDEX Borders_country_2 
+                ON Borders (country_2, country_1)''')
+    
+    
+def addSearch(cur) :
+    '''
+    Schema version 5: full-text index for type-ahead search, one row per 
+    country id. Prefix indexes keep a search on the first letters of a 
+    word as quick as one on a whole word
+    '''
+    cur.execute('''CREATE VIRTUAL TABLE Search USING fts5(
+        name, official, capitals, languages, currencies,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '1 2 3')''')
+    indexSearch(cur)
+    
+    
+def addAggregates(cur) :
+    '''
+    Schema version 6: summary statistics of each metric per continent
+    and worldwide, which is continent 0. NUMERIC columns give back whole
+    numbers as integers, as the Countries table would
+    '''
+    cur.execute('''CREATE TABLE Aggregates(
+        continent INTEGER NOT NULL,
+        metric TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        sum NUMERIC,
+        min NUMERIC,
+        q1 NUMERIC,
+        median NUMERIC,
+        q3 NUMERIC,
+        max NUMERIC,
+        PRIMARY KEY (continent, metric))''')
+    writeAggregates(cur)
+    
+    
+def moveFlags(cur) :
+    '''
+    Schema version 7: flag images move out of Countries into Flags,
+    stored once per distinct image and keyed by its SHA-256 hash
+    Countries keeps only the id, so scanning it reads no image data
+    '''
+    cur.execute('''CREATE TABLE Flags(
+        id INTEGER NOT NULL PRIMARY KEY UNIQUE,
+        hash TEXT NOT NULL UNIQUE,
+        image BLOB NOT NULL,
+        thumb BLOB NOT NULL)''')
+    cur.execute('ALTER TABLE Countries ADD COLUMN flag INTEGER')
+    flag_ids = IdMap()
+    images = []
+    links = []
+    for cid, wflag, thumb in cur.execute('SELECT id, wflag, thumb FROM Countries').fetchall() :
+        digest = hashlib.sha256(wflag).hexdigest()
+        if digest not in flag_ids :
+            images.append((flag_ids.assign(digest), digest, wflag, thumb))
+        links.append((flag_ids[digest], cid))
+    cur.executemany('INSERT INTO Flags (id, hash, image, thumb) VALUES (?, ?, ?, ?)', images)
+    cur.executemany('UPDATE Countries SET flag = ? WHERE id = ?', links)
+    cur.execute('ALTER TABLE Countries DROP COLUMN wflag')
+    cur.execute('ALTER TABLE Countries DROP COLUMN thumb')
+    
+    
+def dropSortIndexes(cur) :
+    '''
+    Schema version 8: drop the indexes version 2 made for listing and 
+    sorting countries in SQL. store.CountryStore does that in memory, so
+    no query reads them, and they only slow down every write
+    '''
+    for index in ['Countries_cont_name', 'Countries_cont_area', 
+                  'Countries_cont_pop', 'Countries_area', 'Countries_pop'] :
+        cur.execute(f'DROP INDEX IF EXISTS {index}')
+    
+    
+# Steps to bring the schema from the previous version up to the key
+MIGRATIONS = {
+    2 : addIndexes,
+    3 : addThumbnails,
+    4 : pairBorders,
+    5 : addSearch,
+    6 : addAggregates,
+    7 : moveFlags,
+    8 : dropSortIndexes,
+    }
+
+
+def getVersion(cur) :
+    '''Return schema version recorded in the DB'''
+    return cur.execute('PRAGMA user_version').fetchone()[0]
+
+
+@tracing.traced
+def migrate(cur) :
+    '''Run every migration step between the DB's version and SCHEMA_VERSION'''
+    for version in range(getVersion(cur) + 1, SCHEMA_VERSION + 1) :
+        with tracing.span(MIGRATIONS[version].__name__, 'backend', version = version) :
+            MIGRATIONS[version](cur)
+        cur.execute(f'PRAGMA user_version = {version}')
         
-     
-        # Antarctica, Bouvet Island, Macau, and Heard Island and McDonald 
-        # Islands have no capitals, currency, and/or languages
-       
-        no_val = ['None']
         
+# Front end queries that must be served by indexes, with sample parameters
+# Checked by checkPlans so a schema change can't bring back full scans
+# Country lists and rankings come from store.CountryStore, not SQL
+PLAN_QUERIES = [
+    (service.CONTINENTS, ()),
+    (service.LANGUAGES, ()),
+    (service.LANGUAGE_COUNTRIES, ('Arabic',)),
+    (service.FLAG, ('IND',)),
+    (service.cardQuery(2), ('India', 'Chad')),
+    (service.multiplesQuery(2), ('India', 'Chad') * len(service.MULTIPLES)),
+    # Each border is stored once, so a country's neighbors need both sides
+    ('SELECT country_2 FROM Borders WHERE country_1 = ?', (1,)),
+    ('SELECT country_1 FROM Borders WHERE country_2 = ?', (1,)),
+    (service.SEARCH, (service.matchQuery('ind'), service.SEARCH_LIMIT)),
+    (service.SEARCH_CONTINENT, (service.matchQuery('ind'), 'Asia', service.SEARCH_LIMIT)),
+    (service.SEARCH_LANGUAGES, (service.matchQuery('ara', 'languages'),)),
+    (service.AGGREGATES, ('area', 'Asia')),
+    (service.AGGREGATES, ('population', None)),
+    ]
+
+# Queries listing every row of a small table, which may scan it
+FULL_LISTINGS = {service.CONTINENTS, service.LANGUAGES}
+
+
+def checkPlans(cur, queries = PLAN_QUERIES) :
+    '''
+    Run EXPLAIN QUERY PLAN on each query
+    Return list of (query, plan step) for every scan, even of a covering
+    index, except in FULL_LISTINGS. The Search table is always scanned, 
+    but with a MATCH it is a lookup, which shows after the colon of 
+    VIRTUAL TABLE INDEX
+    '''
+    problems = []
+    for sql, params in queries :
+        if sql in FULL_LISTINGS :
+            continue
+        for row in cur.execute(f'EXPLAIN QUERY PLAN {sql}', params) :
+            detail = row[-1]
+            matched = 'VIRTUAL TABLE INDEX' in detail and not detail.endswith(':')
+            if detail.startswith('SCAN') and not matched :
+                problems.append((sql, detail))
+    return problems
+    
+
+def makeSession(workers = FLAG_WORKERS) :
+    '''Create HTTP session whose connection pool can serve every worker'''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections = workers, pool_maxsize = workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def transient(error) :
+    '''Return True if a failed download may succeed if tried again'''
+    if isinstance(error, requests.HTTPError) :
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, 
+                              requests.exceptions.ChunkedEncodingError))
+
+
+def fetchFlag(session, url, timeout = FLAG_TIMEOUT, retries = FLAG_RETRIES, \
+              backoff = FLAG_BACKOFF) :
+    '''
+    Download a single flag, retrying with exponential backoff after a
+    connection error, timeout, or server error; a 4xx fails at once
+    '''
+    for attempt in range(retries) :
+        try :
+            response = session.get(url, timeout = timeout)
+            response.raise_for_status()
+            tracing.count('bytes', len(response.content))
+            return response.content
+        except requests.RequestException as e :
+            if attempt == retries - 1 or not transient(e) :
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def checkFlags(workers = FLAG_WORKERS, timeout = 0.5, retries = FLAG_RETRIES) :
+    '''
+    Download flags from a stub HTTP server on a free local port, whose
+    flags answer at once, fail with 500 twice first, stall past timeout 
+    once first, are missing, or always fail with 503
+    Return list of problems: wrong images, wrong number of attempts, or
+    downloads not running concurrently
+    '''
+    import threading
+    from collections import Counter
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    hits = Counter()
+    busy = [0, 0]       # quick flags in flight, most in flight at once
+    lock = threading.Lock()
+    
+    class Stub(BaseHTTPRequestHandler) :
+        protocol_version = 'HTTP/1.1'
+        
+        def do_GET(self) :
+            kind = self.path.split('/')[1]
+            with lock :
+                hits[self.path] += 1
+                tries = hits[self.path]
+                if kind == 'ok' :
+                    busy[0] += 1
+                    busy[1] = max(busy)
+            try :
+                time.sleep(0.05)
+                if kind == 'slow' and tries == 1 :
+                    time.sleep(timeout * 3)
+                status = {'flaky' : 500 if tries <= 2 else 200, 
+                          'missing' : 404, 'down' : 503}.get(kind, 200)
+                body = self.path.encode()
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except OSError :        # the client gave up waiting
+                pass
+            finally :
+                if kind == 'ok' :
+                    with lock :
+                        busy[0] -= 1
+                
+        def log_message(self, *args) :
+            pass
+    
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Stub)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+    
+    def countries(kind, n) :
+        return [{'cca3' : f'{kind}{i}', 'flags' : {'png' : f'{base}/{kind}/{i}.png'}} 
+                for i in range(n)]
+    
+    problems = []
+    try :
+        good = countries('ok', 3 * workers) + countries('flaky', 3) + countries('slow', 2)
         try :
-            caps = val['capital']
-        except KeyError :
-            caps = no_val
+            found = fetchFlags(good, workers = workers, timeout = timeout, 
+                               retries = retries, backoff = 0.01)
+        except requests.RequestException as e :
+            problems.append(f'download failed: {e!r}')
+            found = {}
+        for val in good :
+            url = val['flags']['png']
+            if found.get(val['cca3']) != url[len(base):].encode() :
+                problems.append(f'{url}: wrong or no image')
+        want = {'ok' : 1, 'flaky' : 3, 'slow' : 2}
+        for path, n in hits.items() :
+            if n != want[path.split('/')[1]] :
+                problems.append(f'{path}: {n} attempts, not {want[path.split("/")[1]]}')
+        # Not all at once, as the pool's threads don't all start together
+        if busy[1] < max(2, workers // 2) :
+            problems.append(f'at most {busy[1]} of {workers} downloads at once')
+        
+        for kind, attempts in [('missing', 1), ('down', retries)] :
+            hits.clear()
+            try :
+                fetchFlags(countries(kind, 1), workers = workers, timeout = timeout,
+                           retries = retries, backoff = 0.01)
+                problems.append(f'{kind}: no error raised')
+            except requests.HTTPError :
+                pass
+            if hits[f'/{kind}/0.png'] != attempts :
+                problems.append(f'{kind}: {hits[f"/{kind}/0.png"]} attempts, not {attempts}')
+    finally :
+        server.shutdown()
+        server.server_close()
+    return problems
             
+
+@tracing.traced
+def fetchFlags(countries, session = None, workers = FLAG_WORKERS, \
+               timeout = FLAG_TIMEOUT, retries = FLAG_RETRIES, \
+               backoff = FLAG_BACKOFF, found = None) :
+    '''
+    Download .png flags for all countries, return dict keyed by cca3
+    Flags are added to found as they arrive, so if one download fails 
+    for good, the caller still has every flag that didn't
+    '''
+    own_session = session is None
+    if own_session :
+        session = makeSession(workers)
+    if found is None :
+        found = {}
+    urls = {val['cca3'] : val['flags']['png'] for val in countries}
+    try :
+        with ThreadPoolExecutor(max_workers = workers) as pool :
+            futures = {code : pool.submit(fetchFlag, session, url, timeout, \
+                                          retries, backoff) 
+                       for code, url in urls.items()}
+            error = None
+            for code, future in futures.items() :
+                try :
+                    found[code] = future.result()
+                except requests.RequestException as e :
+                    error = error or e
+        if error is not None :
+            raise error
+        return found
+    finally :
+        if own_session :
+            session.close()
+
+
+@tracing.traced
+def fetchCountries(session, meta, url = API_URL) :
+    '''
+    Download all countries, using stored validators for a conditional GET
+    Return response and new validators, or None for response if unchanged
+    '''
+    headers = {}
+    if meta.get('etag') :
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified') :
+        headers['If-Modified-Since'] = meta['last_modified']
+    response = session.get(url, headers = headers, timeout = API_TIMEOUT, 
+                           stream = True)
+    response.raise_for_status()
+    if response.status_code == 304 :
+        return None, {}
+    validators = {'etag' : response.headers.get('ETag'), 
+                  'last_modified' : response.headers.get('Last-Modified')}
+    return response, validators
+
+
+def parseCountries(file) :
+    '''
+    Yield countries one at a time from the JSON array in a binary file
+    Parsed with ijson, so only the current country is ever in memory
+    '''
+    # floats, not Decimals, so values and hashes match json.load
+    yield from ijson.items(file, 'item', use_float = True)
+
+
+class TeeReader :
+    '''Binary file wrapper that writes everything read to a copy as well'''
+    def __init__(self, file, copy) :
+        self._file = file
+        self._copy = copy
+        
+        
+    def read(self, size = -1) :
+        data = self._file.read(size)
+        self._copy.write(data)
+        return data
+
+
+class FlagCache :
+    '''
+    Content-addressed store of flag images on disk
+    Each image is saved once as <sha256>.png; index.json maps flag URLs to hashes
+    '''
+    INDEX = 'index.json'
+    
+    def __init__(self, directory = FLAG_DIR) :
+        self._dir = directory
+        self._index_path = os.path.join(directory, FlagCache.INDEX)
         try :
-            currens = [key['name'] for key in val['currencies'].values()]
-        except KeyError :
-            currens = no_val
+            with open(self._index_path) as file :
+                self._index = json.load(file)
+        except FileNotFoundError :
+            self._index = {}
+        self._dirty = False
+            
             
+    def get(self, url) :
+        '''Return cached image for url, or None if it has not been stored'''
+        digest = self._index.get(url)
+        if digest is None :
+            return None
         try :
-            langs = val['languages'].values()
-        except KeyError :
-            langs = no_val
+            with open(os.path.join(self._dir, f'{digest}.png'), 'rb') as file :
+                return file.read()
+        except FileNotFoundError :
+            return None
+        
+        
+    def put(self, url, data) :
+        '''Store image for url, writing the file only if the content is new'''
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self._dir, f'{digest}.png')
+        if not os.path.exists(path) :
+            os.makedirs(self._dir, exist_ok = True)
+            with open(path, 'wb') as file :
+                file.write(data)
+        if self._index.get(url) != digest :
+            self._index[url] = digest
+            self._dirty = True
             
-        # Island nations have no key ['borders']
+            
+    def save(self) :
+        '''Write index to disk if it changed'''
+        if not self._dirty :
+            return
+        os.makedirs(self._dir, exist_ok = True)
+        temp = self._index_path + '.tmp'
+        with open(temp, 'w') as file :
+            json.dump(self._index, file, indent = 1, sort_keys = True)
+        os.replace(temp, self._index_path)
+        self._dirty = False
+
+
+class ApiSource :
+    '''
+    Live REST Countries endpoint
+    Flags are kept in a FlagCache so repeated builds don't download them again
+    If snapshot is given, each new API response is also saved there
+    '''
+    def __init__(self, url = API_URL, flag_dir = FLAG_DIR, snapshot = None, \
+                 workers = FLAG_WORKERS) :
+        self._url = url
+        self._cache = FlagCache(flag_dir) if flag_dir else None
+        self._snapshot = snapshot
+        self._workers = workers
+        self._session = makeSession(workers)
+        
+        
+    @tracing.traced
+    def fetch(self, meta) :
+        '''
+        Return countries and validators, or None for countries if API data 
+        unchanged. Countries are yielded as the response is read
+        '''
+        response, validators = fetchCountries(self._session, meta, self._url)
+        if response is None :
+            return None, validators
+        return self._stream(response), validators
+    
+    
+    def _stream(self, response) :
+        '''Yield countries from response, copying it to the snapshot if set'''
+        response.raw.decode_content = True     # undo gzip
+        try :
+            if not self._snapshot :
+                yield from parseCountries(tracing.reader(response.raw))
+                return
+            # Replace the old snapshot only once the whole response is in
+            partial = self._snapshot + '.part'
+            with open(partial, 'wb') as copy :
+                yield from parseCountries(TeeReader(tracing.reader(response.raw), copy))
+                copy.write(response.raw.read())
+            os.replace(partial, self._snapshot)
+        finally :
+            response.close()
+    
+    
+    @tracing.traced
+    def flags(self, countries) :
+        '''Return flags keyed by cca3, downloading only those not cached'''
+        if self._cache is None :
+            return fetchFlags(countries, self._session, self._workers)
+        flags = {}
+        missing = []
+        for val in countries :
+            data = self._cache.get(val['flags']['png'])
+            if data is None :
+                missing.append(val)
+            else :
+                flags[val['cca3']] = data
+        downloaded = {}
+        try :
+            fetchFlags(missing, self._session, self._workers, found = downloaded)
+        finally :
+            # Cached even if another flag failed, so a rerun won't fetch them again
+            for val in missing :
+                if val['cca3'] in downloaded :
+                    self._cache.put(val['flags']['png'], downloaded[val['cca3']])
+            self._cache.save()
+        flags.update(downloaded)
+        return flags
+    
+    
+    def close(self) :
+        self._session.close()
+        
+        
+    def __enter__(self) :
+        return self
+    
+    
+    def __exit__(self, *exc) :
+        self.close()
+
+
+class SnapshotSource :
+    '''
+    JSON snapshot file plus FlagCache directory, for fully offline builds
+    The snapshot's own hash stands in for the API's ETag
+    '''
+    def __init__(self, path = SNAPSHOT, flag_dir = FLAG_DIR) :
+        self._path = path
+        self._dir = flag_dir
+        self._cache = FlagCache(flag_dir)
+        
+        
+    @tracing.traced
+    def fetch(self, meta) :
+        '''
+        Return countries and validators, or None for countries if snapshot 
+        unchanged. Countries are yielded as the file is read
+        '''
+        digest = hashlib.sha256()
+        with open(self._path, 'rb') as file :
+            for chunk in iter(lambda : file.read(READ_SIZE), b'') :
+                digest.update(chunk)
+        etag = digest.hexdigest()
+        if meta.get('etag') == etag :
+            return None, {}
+        return self._stream(), {'etag' : etag, 'last_modified' : None}
+    
+    
+    def _stream(self) :
+        with open(self._path, 'rb') as file :
+            yield from parseCountries(tracing.reader(file))
+    
+    
+    @tracing.traced
+    def flags(self, countries) :
+        '''Return flags keyed by cca3, all of which must already be cached'''
+        flags = {}
+        for val in countries :
+            data = self._cache.get(val['flags']['png'])
+            if data is None :
+                raise FileNotFoundError(f"No flag for {val['cca3']} in {self._dir}")
+            flags[val['cca3']] = data
+        return flags
+    
+    
+    def close(self) :
+        pass
+    
+    
+    def __enter__(self) :
+        return self
+    
+    
+    def __exit__(self, *exc) :
+        self.close()
+
+
+class Thumbnails(dict) :
+    '''Make card-sized .png thumbnails, resizing each distinct image once'''
+    def make(self, data) :
+        '''Return thumbnail for full-size .png data'''
         try :
-            borders_dict[country] = val['borders']
+            return self[data]
         except KeyError :
-            borders_dict[country] = no_val
-            
-        # Kosovo has no key ['independent']
-        try : 
-            indep = 1 if val['independent'] else 0
+            img = Image.open(io.BytesIO(data)).convert('RGBA')
+            img = img.resize(THUMB_SIZE, Image.LANCZOS)
+            out = io.BytesIO()
+            img.save(out, 'PNG', optimize = True)
+            self[data] = out.getvalue()
+            return self[data]
+
+
+def countryHash(val) :
+    '''Fingerprint the JSON for one country to tell whether it changed'''
+    text = json.dumps(val, sort_keys = True, ensure_ascii = False)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def parseCountry(val) :
+    '''Clean up a single country from the JSON, return dict of its values'''
+    country = val['name']['common']
+     
+    # Prepare to handle special cases before attempting to write tables
+    # Or writing will crash / tables will have wrong data
+ 
+    # Antarctica, Bouvet Island, Macau, and Heard Island and McDonald 
+    # Islands have no capitals, currency, and/or languages
+    try :
+        caps = val['capital']
+    except KeyError :
+        caps = NO_VAL
+        
+    try :
+        currens = [key['name'] for key in val['currencies'].values()]
+    except KeyError :
+        currens = NO_VAL
+        
+    try :
+        langs = list(val['languages'].values())
+    except KeyError :
+        langs = NO_VAL
+        
+    # Island nations have no key ['borders']
+    borders = val.get('borders', [])
+        
+    # Kosovo has no key ['independent']
+    try : 
+        indep = 1 if val['independent'] else 0
+    except KeyError :
+        indep = 1      # Most UN Nations recognize Kosovo's independence
+    
+    # API has wrong map for Indonesia, shows Hungary?!
+    if country == 'Indonesia' :
+        map_url = 'https://goo.gl/maps/w7M4eCTtCuFdSnJx9'
+    else : 
+        map_url = val['maps']['googleMaps']
+        
+    # API has wrong area for Svalbard and Jan Mayen, shows -1
+    if country == 'Svalbard and Jan Mayen' :
+        area = 61399
+    else :
+        area = val['area']
+        
+     # Language list for India is wonky, shows only three languages
+     # Should be either just 2 official or include all scheduled languages
+    if country == 'India' :
+        langs = ['Hindi', 'English', 'Assamese', 'Bengali', 'Bodo', \
+            'Dogri', 'Gujarati', 'Kannada', 'Kashmiri', 'Konkani', \
+            'Maithili', 'Malayalam', 'Manipuri', 'Marathi', 'Nepali', \
+            'Odia', 'Punjabi', 'Sanskrit', 'Santali', 'Sindhi', \
+            'Tamil', 'Telugu', 'Urdu']
+    
+    return {'name' : country, 'official' : val['name']['official'], 
+            'code' : val['cca3'], 'indep' : indep, 'mflag' : val['flag'], 
+            'continent' : val['continents'][0], 'area' : area, 
+            'population' : val['population'], 'map' : map_url, 
+            'caps' : caps, 'langs' : langs, 'currens' : currens, 
+            'borders' : borders, 'hash' : countryHash(val)}
+
+
+class IdMap(dict) :
+    '''Map names to surrogate ids, handing out the next unused id to new names'''
+    def __init__(self, pairs = ()) :
+        super().__init__(pairs)
+        self._next = max(self.values(), default = 0) + 1
+        self.added = []
+        
+        
+    def assign(self, name) :
+        '''Return id for name, allocating the next one if name is new'''
+        try :
+            return self[name]
         except KeyError :
-            indep = 1      # Most UN Nations recognize Kosovo's independence
+            self[name] = self._next
+            self.added.append((self._next, name))
+            self._next += 1
+            return self[name]
+
+
+def loadIds(cur) :
+    '''Read existing surrogate ids so an incremental refresh can extend them'''
+    lookups = {table : IdMap(cur.execute(f'SELECT name, id FROM {table}')) 
+               for table in LOOKUP_TABLES}
+    lookups['Flags'] = IdMap(cur.execute('SELECT hash, id FROM Flags'))
+    codes = IdMap(cur.execute('SELECT code, id FROM Countries'))
+    return lookups, codes
+
+
+@tracing.traced
+def normalize(countries, flags, lookups = None, codes = None) :
+    '''
+    Walk through a batch of JSON once and build the rows for every table
+    Surrogate ids are assigned from dicts, so no SELECT is needed to find them
+    Lookup tables only get rows for names not already in lookups, and
+    Flags only for images whose hash is not already in lookups['Flags']
+    '''
+    if lookups is None :
+        lookups = {table : IdMap() for table in [*LOOKUP_TABLES, 'Flags']}
+    if codes is None :
+        codes = IdMap()
+    rows = {table : [] for table in TABLE_COLUMNS}
+    thumbs = Thumbnails()
+    
+    for val in countries :
+        info = parseCountry(val)
+        cid = codes.assign(info['code'])
+        cont_id = lookups['Continents'].assign(info['continent'])
         
-        # API has wrong map for Indonesia, shows Hungary?!
-        if country == 'Indonesia' :
-            map_url = 'https://goo.gl/maps/w7M4eCTtCuFdSnJx9'
-        else : 
-            map_url = val['maps']['googleMaps']
-            
-        # API has wrong area for Svalbard and Jan Mayen, shows -1
-        if country == 'Svalbard and Jan Mayen' :
-            area = 61399
-        else :
-            area = val['area']
-            
-         # Language list for India is wonky, shows only three languages
-         # Should be either just 2 official or include all scheduled languages
-        if country == 'India' :
-            langs = ['Hindi', 'English', 'Assamese', 'Bengali', 'Bodo', \
-                'Dogri', 'Gujarati', 'Kannada', 'Kashmiri', 'Konkani', \
-                'Maithili', 'Malayalam', 'Manipuri', 'Marathi', 'Nepali', \
-                'Odia', 'Punjabi', 'Sanskrit', 'Santali', 'Sindhi', \
-                'Tamil', 'Telugu', 'Urdu']
-                
-        # Get .png of flag for Windows display
-        wflag = requests.get(val['flags']['png']).content
-                          
-        # Populate Continents table
-        cur.execute('INSERT INTO Continents (name) VALUES (?)', \
-                    (val['continents'][0],))
-        cur.execute('SELECT id FROM Continents WHERE name = ?', \
-                    (val['continents'][0],))
-        cont_id = cur.fetchone()[0]
-
-        # Populate Countries table
-        cur.execute('''INSERT INTO Countries (name, official, code, 
-                    indep, mflag, wflag, continent, area, population, map) 
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', \
-                    (country, val['name']['official'], val['cca3'], \
-                     indep, val['flag'], wflag, cont_id, area, \
-                    val['population'], map_url))
-        cur.execute('SELECT id FROM Countries WHERE name = ?', (country,))
-        cid = cur.fetchone()[0]
-        
-        # Populate remaining tables including junction tables
-        writeOthers(cur, cid, caps, 'Capitals', 'Count_Cap_Jn', 'capital')
-        writeOthers(cur, cid, langs, 'Languages', 'Count_Lang_Jn', 'language')
-        writeOthers(cur, cid, currens, 'Currencies', 'Count_Curr_Jn', 'currency')
-    
-    # Populate Borders table
-    writeBorders(cur, borders_dict, no_val)
-    
-    
-def writeBorders(cur, borders_dict, no_val) :
-    '''Write Borders table'''
-    for nation, borders in borders_dict.items() :
-        if borders != no_val :
-            cur.execute('''SELECT id FROM Countries 
-                    WHERE name = ?''', (nation,))
-            cid = cur.fetchone()[0]
-            for border in borders :
-                cur.execute('''SELECT id FROM Countries 
-                            WHERE code = ?''', (border,))
-                bid = cur.fetchone()[0]
-                cur.execute('''INSERT INTO Borders (country_1, country_2)
-                            VALUES (?, ?)''', (cid, bid))
-            
+        # Get .png of flag for Windows display, downloaded ahead of time
+        # Countries refer to it by id; each distinct image is stored once
+        wflag = flags[info['code']]
+        digest = hashlib.sha256(wflag).hexdigest()
+        if digest not in lookups['Flags'] :
+            rows['Flags'].append((lookups['Flags'].assign(digest), digest, 
+                                  wflag, thumbs.make(wflag)))
+        rows['Countries'].append((cid, info['name'], info['official'], \
+                info['code'], info['indep'], info['mflag'], \
+                lookups['Flags'][digest], cont_id, info['area'], \
+                info['population'], info['map'], info['hash']))
+        
+        for key, table, junction in JUNCTIONS :
+            for item in info[key] :
+                rows[junction].append((cid, lookups[table].assign(item)))
+        
+        # Can't resolve a border until the neighboring country has an id
+        # So borders are staged by code and resolved by writeBorders
+        rows['BorderStage'].extend((cid, code) for code in info['borders'])
+    
+    for table in LOOKUP_TABLES :
+        rows[table], lookups[table].added = lookups[table].added, []
+    lookups['Flags'].added.clear()
+    return rows
+
+
+@tracing.traced
+def writeTables (countries, cur, flags, lookups = None, codes = None, 
+                 replace = False) :
+    '''
+    Write data from JSON into tables, one executemany per table, and
+    index the countries for search. With replace = True countries already 
+    in the tables are deleted first, along with their join rows, so a
+    country clashing with another on a unique column still fails. Borders
+    are only staged; see writeBorders
+    '''
+    rows = normalize(countries, flags, lookups, codes)
+    ids = [(row[0],) for row in rows['Countries']]
+    if replace :
+        deleteJoins(cur, ids)
+        cur.execute('DELETE FROM Countries WHERE id IN (SELECT id FROM Stale)')
+    insertRows(cur, rows)
+    indexSearch(cur, ids)
+    
+    
+@tracing.traced
+def insertRows(cur, rows) :
+    '''Write rows made by normalize, one executemany per table'''
+    cur.execute(STAGE_BORDERS)
+    for table, cols in TABLE_COLUMNS.items() :
+        marks = ', '.join('?' * len(cols))
+        cur.executemany(f'''INSERT INTO {table} 
+                        ({', '.join(cols)}) VALUES ({marks})''', rows[table])
+        tracing.count('rows', len(rows[table]))
+
+
+@tracing.traced
+def writeBorders(cur) :
+    '''
+    Resolve staged borders to country ids with one join, then clear them
+    Each border is written once as (lower id, higher id), however many 
+    times it was staged. Return (country code, neighbor code) for every
+    neighbor code that matches no country; those borders are skipped
+    '''
+    cur.execute(STAGE_BORDERS)
+    cur.execute('''INSERT INTO Borders (country_1, country_2)
+                SELECT DISTINCT MIN(S.country, C.id), MAX(S.country, C.id)
+                FROM BorderStage S INNER JOIN Countries C ON C.code = S.code
+                WHERE S.country != C.id''')
+    tracing.count('rows', cur.rowcount)
+    unresolved = cur.execute('''SELECT C.code, S.code FROM BorderStage S
+                INNER JOIN Countries C ON C.id = S.country
+                WHERE S.code NOT IN (SELECT code FROM Countries)
+                ORDER BY C.code, S.code''').fetchall()
+    cur.execute('DELETE FROM BorderStage')
+    return unresolved
+
+
+def batched(items, size) :
+    '''Yield lists of up to size items, consuming items lazily'''
+    items = iter(items)
+    batch = list(islice(items, size))
+    while batch :
+        yield batch
+        batch = list(islice(items, size))
+
+
+@tracing.traced
+def ingest(cur, countries, source, hashes = None, batch_size = BATCH_SIZE, 
+           checkpoint = None) :
+    '''
+    Write countries as they stream in, batch_size at a time, then borders
+    With hashes, a dict of code to hash of what the tables already hold,
+    only countries that changed are written, replacing their old rows
+    Flags are fetched per batch, for the countries being written
+    checkpoint, if given, is called with the number of batches done after
+    each one is written
+    Return set of codes of every country in the stream, and the list
+    of unresolved borders from writeBorders
+    '''
+    lookups, codes = loadIds(cur)
+    seen = set()
+    cur.execute(STAGE_BORDERS)
+    for done, batch in enumerate(batched(countries, batch_size), 1) :
+        seen.update(val['cca3'] for val in batch)
+        if hashes is not None :
+            changed = []
+            kept = []
+            for val in batch :
+                if hashes.get(val['cca3']) != countryHash(val) :
+                    changed.append(val)
+                else :
+                    kept.extend((codes[val['cca3']], code) 
+                                for code in val.get('borders', []))
+            # Borders of unchanged countries are staged again too, so a 
+            # border listed only by them survives a change to the neighbor
+            cur.executemany('''INSERT INTO BorderStage (country, code) 
+                            VALUES (?, ?)''', kept)
+            batch = changed
+        if batch :
+            writeTables(batch, cur, source.flags(batch), lookups, codes, 
+                        replace = hashes is not None)
+        if checkpoint is not None :
+            checkpoint(done)
+    return seen, writeBorders(cur)
+
+
+def markStale(cur, ids) :
+    '''Put the given country ids in temp table Stale, for set-based updates'''
+    cur.execute('CREATE TEMP TABLE IF NOT EXISTS Stale(id INTEGER PRIMARY KEY)')
+    cur.execute('DELETE FROM Stale')
+    cur.executemany('INSERT OR IGNORE INTO Stale (id) VALUES (?)', ids)
+
+
+@tracing.traced
+def deleteJoins(cur, ids) :
+    '''Delete junction and border rows for the countries with given ids'''
+    markStale(cur, ids)
+    for _, _, junction in JUNCTIONS :
+        cur.execute(f'''DELETE FROM {junction} 
+                    WHERE country IN (SELECT id FROM Stale)''')
+    # A border is stored once, whichever side lists it, so both sides go
+    cur.execute('DELETE FROM Borders WHERE country_1 IN (SELECT id FROM Stale)')
+    cur.execute('DELETE FROM Borders WHERE country_2 IN (SELECT id FROM Stale)')
+    
+    
+@tracing.traced
+def deleteCountries(cur, codes) :
+    '''Remove countries no longer in the API, with everything that refers to them'''
+    ids = [(cid,) for code, cid in cur.execute('SELECT code, id FROM Countries')
+           if code in codes]
+    deleteJoins(cur, ids)
+    cur.execute('DELETE FROM Search WHERE rowid IN (SELECT id FROM Stale)')
+    cur.execute('DELETE FROM Countries WHERE id IN (SELECT id FROM Stale)')
+
+
+@tracing.traced
+def deleteUnusedFlags(cur) :
+    '''Remove flag images no country refers to any more'''
+    cur.execute('DELETE FROM Flags WHERE id NOT IN (SELECT flag FROM Countries)')
+
+
+@tracing.traced
+def deleteUnusedLookups(cur) :
+    '''Remove continents, capitals, languages, and currencies no country has any more'''
+    for _, table, junction in JUNCTIONS :
+        cur.execute(f'''DELETE FROM {table} WHERE id NOT IN 
+                    (SELECT {JUNCTION_COLUMNS[junction]} FROM {junction})''')
+    cur.execute('DELETE FROM Continents WHERE id NOT IN (SELECT continent FROM Countries)')
+
+
+@tracing.traced
+def indexSearch(cur, ids = None) :
+    '''
+    Rewrite the search rows of the countries with given ids, or of all
+    Each row holds the country's names, capitals, languages, and currencies
+    '''
+    if ids is None :
+        cur.execute('DELETE FROM Search')
+        where = ''
+    else :
+        markStale(cur, ids)
+        cur.execute('DELETE FROM Search WHERE rowid IN (SELECT id FROM Stale)')
+        where = 'WHERE C.id IN (SELECT id FROM Stale)'
+    items = ', '.join(f'''(SELECT group_concat(T.name, ' ') FROM {junction} J
+                INNER JOIN {table} T ON J.{JUNCTION_COLUMNS[junction]} = T.id
+                WHERE J.country = C.id AND T.name != ?)'''
+                for _, table, junction in JUNCTIONS)
+    cur.execute(f'''INSERT INTO Search 
+                (rowid, name, official, capitals, languages, currencies)
+                SELECT C.id, C.name, C.official, {items} 
+                FROM Countries C {where}''', NO_VAL * len(JUNCTIONS))
+
+
+@tracing.traced
+def writeAggregates(cur) :
+    '''
+    Recompute the Aggregates table from every row of Countries, with a 
+    row for every continent, even one left with no countries
+    A sum of densities means nothing, so density's sum is left NULL
+    '''
+    rows = cur.execute('SELECT continent, area, population FROM Countries').fetchall()
+    conts, areas, pops = zip(*rows) if rows else ([],) * 3
+    conts = np.array(conts, dtype = np.int64)
+    areas = np.array(areas, dtype = np.float64)
+    pops = np.array(pops, dtype = np.int64)
+    
+    found = []
+    ids = [cid for cid, in cur.execute('SELECT id FROM Continents').fetchall()]
+    for cid in [0, *ids] :
+        members = conts == cid if cid else slice(None)
+        area, pop = areas[members], pops[members]
+        land = area > 0
+        columns = {'area' : area, 'population' : pop, 
+                   'density' : pop[land] / area[land]}
+        for metric in AGGREGATE_METRICS :
+            stats = describe(columns[metric])
+            if metric == 'density' :
+                stats['sum'] = None
+            found.append((cid, metric, *(stats[key] for key in STATS)))
+    cur.execute('DELETE FROM Aggregates')
+    cur.executemany(f'''INSERT INTO Aggregates (continent, metric, {', '.join(STATS)})
+                    VALUES ({', '.join('?' * (len(STATS) + 2))})''', found)
+
+
+@tracing.traced
+def writeMeta(cur, meta) :
+    '''Store API validators and stamp the time of this check'''
+    meta = dict(meta, checked = str(time.time()))
+    cur.executemany('INSERT OR REPLACE INTO Meta (key, value) VALUES (?, ?)', \
+                    meta.items())
+    
+
+def readMeta(path) :
+    '''
+    Read Meta table and schema version without writing to the DB
+    Return empty dict and version 0 if unavailable
+    '''
+    try :
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri = True)
+    except sqlite3.OperationalError :
+        return {}, 0
+    try :
+        return dict(conn.execute('SELECT key, value FROM Meta')), \
+            getVersion(conn)
+    except sqlite3.DatabaseError :
+        return {}, 0
+    finally :
+        conn.close()
+
+
+def readProgress(path) :
+    '''Return checkpoints recorded in the build file at path, or empty dict'''
+    if not os.path.exists(path) :
+        return {}
+    conn = sqlite3.connect(path)
+    try :
+        return dict(conn.execute('SELECT key, value FROM Progress'))
+    except sqlite3.DatabaseError :
+        return {}
+    finally :
+        conn.close()
+
+
+def writeProgress(cur, **values) :
+    '''Record checkpoints; they last once the transaction is committed'''
+    cur.execute(PROGRESS)
+    cur.executemany('INSERT OR REPLACE INTO Progress (key, value) VALUES (?, ?)', 
+                    values.items())
+
 
-def writeOthers (cur, country_id, some_list, tab1, tab2, desc) :
-    '''Helper function to write many-to-many tables'''
-    for item in some_list :
-        cur.execute(f'INSERT INTO {tab1} (name) VALUES (?)', (item,))
-        cur.execute(f'SELECT id FROM {tab1} WHERE name = ?', (item,))
-        current_id = cur.fetchone()[0]
-        cur.execute(f'''INSERT INTO {tab2} (country, {desc})
-                    VALUES (?, ?)''', (country_id, current_id))
+def applyPragmas(cur) :
+    '''Tune connection for a one-off bulk build'''
+    for pragma in BUILD_PRAGMAS :
+        cur.execute(f'PRAGMA {pragma}')
         
 
-def main () :
-    '''Code driver'''
-    countries = requests.get(API_URL).json()
-    conn = sqlite3.connect(DATABASE)
-    cur = conn.cursor()
-    createTables(cur) 
-    writeTables(countries, cur)
-    conn.commit()
+@tracing.traced
+def startBuild(path, copy = True) :
+    '''
+    Return connection to the build file for the DB at path, in WAL mode,
+    and the checkpoints recorded in it
+    A build left by a failed run is resumed if it has the current schema,
+    and is a full rebuild or copy is set. Otherwise a new build is begun,
+    as a copy of the DB with copy, for an incremental refresh
+    '''
+    building = path + BUILDING
+    progress = readProgress(building)
+    if progress.get('schema') == SCHEMA_VERSION and (copy or progress.get('full')) :
+        conn = sqlite3.connect(building)
+        tracing.watch(conn)
+        return conn, progress
+    
+    # Left behind by a build that can't be resumed
+    for leftover in ('', '-wal', '-shm', '-journal') :
+        if os.path.exists(building + leftover) :
+            os.remove(building + leftover)
+    conn = sqlite3.connect(building)
+    tracing.watch(conn)
+    if copy and os.path.exists(path) :
+        source = sqlite3.connect(f'file:{path}?mode=ro', uri = True)
+        source.backup(conn)
+        source.close()
+    conn.execute('PRAGMA journal_mode = WAL')
+    return conn, {}
+
+
+@tracing.traced
+def finishBuild(conn, path) :
+    '''Fold the WAL back into the build file, close it, and swap it in'''
+    # Build pragmas skip syncing to disk, but the swapped-in file must be whole
+    conn.execute('PRAGMA synchronous = FULL')
+    # A single self-contained file, with no -wal or -shm files to move too
+    conn.execute('PRAGMA journal_mode = DELETE')
     conn.close()
+    os.replace(path + BUILDING, path + BUILT)
+    installBuild(path)
+
+
+def lockBuild(path) :
+    '''
+    Return the lock file for building the DB at path, locked, or None if
+    another process holds it. Closing the file releases the lock
+    '''
+    file = open(path + LOCK, 'a+b')
+    try :
+        if os.name == 'nt' :
+            import msvcrt
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        else :
+            import fcntl
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError :
+        file.close()
+        return None
+    return file
+
+
+@tracing.traced
+def installBuild(path = DATABASE) :
+    '''
+    Swap a finished build in for the DB at path, if there is one
+    The rename is atomic, and connections already open keep reading the
+    old DB until they reopen. Windows refuses while the DB is open, so
+    the build waits for the next call. Return True if a build was installed
+    '''
+    built = path + BUILT
+    if not os.path.exists(built) :
+        return False
+    try :
+        os.replace(built, path)
+    except PermissionError :
+        return False
+    return True
+
+
+@tracing.traced
+def main (full = False, ttl = REFRESH_TTL, source = None) :
+    '''
+    Code driver
+    By default refresh incrementally: do nothing if the DB was checked 
+    within ttl seconds, otherwise rewrite only countries whose data changed
+    With full = True drop and rebuild every table
+    Data comes from source, the live API unless another source is given
+    The refresh is built in a separate file and swapped in when complete,
+    so the DB can be read throughout. Return True if a new DB was built
+    with different data or schema from the old one
+    The build is committed after every batch. If it fails, the build file
+    is kept, and the next run resumes it: countries already written are
+    passed over as unchanged, so neither their flags nor rows are redone
+    Only one process builds at a time. A refresh started while another 
+    is under way, say by the window and the server both, does nothing
+    '''
+    lock = lockBuild(DATABASE)
+    if lock is None :
+        print('Another refresh is under way', file = sys.stderr)
+        if source is not None :
+            source.close()
+        return False
+    try :
+        return build(full, ttl, source)
+    finally :
+        lock.close()
+
+
+@tracing.traced
+def build(full, ttl, source) :
+    '''Refresh the DB as main describes, while holding the build lock'''
+    installBuild(DATABASE)
+    meta, version = readMeta(DATABASE)
+    unfinished = os.path.exists(DATABASE + BUILDING)
+    if not meta or version < 1 :
+        full = True
+    elif not full and not unfinished and version == SCHEMA_VERSION and \
+            time.time() - float(meta['checked']) < ttl :
+        if source is not None :
+            source.close()
+        return False
+    
+    if source is None :
+        source = ApiSource()
+    conn, progress = startBuild(DATABASE, copy = not full)
+    cur = conn.cursor()
+    
+    def checkpoint(batches) :
+        '''Commit the batches written so far'''
+        writeProgress(cur, batches = batches)
+        conn.commit()
+        cur.execute('BEGIN')
+    
+    try :
+        with source :
+            if progress :
+                print(f'Resuming build after {progress.get("batches", 0)} batches', 
+                      file = sys.stderr)
+                full = bool(progress['full'])
+            # A resumed build needs all the data, not only what changed
+            countries, validators = source.fetch({} if full or progress else meta)
+            applyPragmas(cur)
+            cur.execute('BEGIN')
+            if countries is None :      # data unchanged since last check
+                version = getVersion(cur)
+                migrate(cur)
+                migrated = getVersion(cur) != version
+                writeMeta(cur, {})
+                conn.commit()
+                finishBuild(conn, DATABASE)
+                # Only the time of the check changed, unless the schema did
+                return migrated
+            
+            # Countries are written while the response is still being read
+            # Tables must have the current columns before any rows are written
+            if not progress :
+                if full :
+                    createTables(cur) 
+                migrate(cur)
+                writeProgress(cur, schema = SCHEMA_VERSION, full = int(full), batches = 0)
+                checkpoint(0)
+            if full and not progress :
+                _, unresolved = ingest(cur, countries, source, checkpoint = checkpoint)
+            else :
+                hashes = dict(cur.execute('SELECT code, hash FROM Countries'))
+                seen, unresolved = ingest(cur, countries, source, hashes, 
+                                          checkpoint = checkpoint)
+                deleteCountries(cur, hashes.keys() - seen)
+                deleteUnusedFlags(cur)
+                deleteUnusedLookups(cur)
+            writeAggregates(cur)
+            for code, neighbor in unresolved :
+                print(f'Skipped border of {code} with unknown country {neighbor}', 
+                      file = sys.stderr)
+            writeMeta(cur, validators)
+            cur.execute('DROP TABLE Progress')
+            conn.commit()
+    except BaseException :
+        # Batches already committed stay in the build file for the next run
+        conn.close()
+        raise
+    finishBuild(conn, DATABASE)
+    return True
 
 
 if __name__ == '__main__' :
-    main()
+    parser = argparse.ArgumentParser(description = 'Build countries.db')
+    parser.add_argument('--full', action = 'store_true', 
+                        help = 'drop and rebuild every table')
+    parser.add_argument('--ttl', type = float, default = REFRESH_TTL, 
+                        help = 'seconds before the DB is checked again')
+    parser.add_argument('--offline', action = 'store_true', 
+                        help = 'build from snapshot and flag directory only')
+    parser.add_argument('--save-snapshot', action = 'store_true', 
+                        help = 'save API response for later offline builds')
+    parser.add_argument('--snapshot', default = SNAPSHOT, 
+                        help = 'path of JSON snapshot')
+    parser.add_argument('--flags', default = FLAG_DIR, 
+                        help = 'directory of cached flag images')
+    parser.add_argument('--check-plans', action = 'store_true', 
+                        help = 'report front end queries that scan a table')
+    parser.add_argument('--check-flags', action = 'store_true', 
+                        help = 'test flag downloads against a local stub server')
+    parser.add_argument('--trace', metavar = 'FILE', 
+                        help = f'write a Chrome trace of the build to FILE; also set by ${tracing.ENV}')
+    args = parser.parse_args()
+    if args.trace :
+        tracing.enable(args.trace)
+    if args.check_plans :
+        conn = sqlite3.connect(DATABASE)
+        problems = checkPlans(conn.cursor())
+        conn.close()
+        for sql, detail in problems :
+            print(f'{detail}\n    in {" ".join(sql.split())}')
+        raise SystemExit(1 if problems else 0)
+    if args.check_flags :
+        problems = checkFlags()
+        for problem in problems :
+            print(problem)
+        raise SystemExit(1 if problems else 0)
+    if args.offline :
+        source = SnapshotSource(args.snapshot, args.flags)
+    else :
+        source = ApiSource(flag_dir = args.flags, 
+                           snapshot = args.snapshot if args.save_snapshot else None)
+    main(args.full, args.ttl, source)
@@ -0,0 +1,322 @@
+'''
+Tour de World Benchmarks
+Authors: Surajit Bose, James Kang
+Copyright © 2023
+
+This project relies on the REST Countries API by Alejandro Matos:
+    - https://restcountries.com/
+    - https://gitlab.com/restcountries/restcountries
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, you can obtain one at https://mozilla.org/MPL/2.0/
+
+Times each ingest stage and each query path behind the front end on
+synthetic data shaped like the REST Countries response, at several scales.
+Each scale runs in its own process so peak memory is measured separately.
+'''
+
+
+import argparse
+import io
+import json
+import math
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import backend
+import service
+import graph      # imported up front so 'load store' and 'load graph'
+import store      # time the load only
+
+BASELINE = 'benchmark_baseline.json'
+SCALES = [250, 2500, 25000]
+TOLERANCE = 1.25     # slower than baseline by this factor counts as regression
+NOISE_FLOOR = 0.005  # seconds; smaller slowdowns are timer noise, not regressions
+REPEAT = 5           # runs of each query path; the median is reported
+
+FLAG_VARIETY = 64    # distinct flag images shared among synthetic countries
+FLAG_SIZE = (320, 160)
+
+# Real share of countries per continent in the API response
+CONTINENTS = {'Africa' : 58, 'Asia' : 50, 'Europe' : 53, 'North America' : 41,
+              'South America' : 14, 'Oceania' : 27, 'Antarctica' : 5}
+
+
+def code(i) :
+    '''Return unique code like the API's cca3, longer once 3 letters run out'''
+    letters = ''
+    while i or len(letters) < 3 :
+        i, rem = divmod(i, 26)
+        letters = chr(ord('A') + rem) + letters
+    return letters
+
+
+def fanOut(rng, weights) :
+    '''Pick a count from {count : weight}'''
+    return rng.choices(list(weights), list(weights.values()))[0]
+
+
+def generate(count, seed = 0) :
+    '''
+    Return list of count countries shaped like the REST Countries response
+    Fan-out of languages, capitals, and currencies follows the real data:
+    mostly one of each, a few with many (India has 23 languages). Shared
+    languages and currencies (English, Euro) are drawn from a skewed pool.
+    Borders join neighboring cells on a grid per continent, so they are
+    symmetric, and about a fifth of countries are islands with none
+    '''
+    rng = random.Random(seed)
+    continents = rng.choices(list(CONTINENTS), list(CONTINENTS.values()), k = count)
+    lang_pool = max(20, int(count * 0.6))
+    curr_pool = max(10, count // 2)
+
+    # Lay out each continent's countries on a square grid for borders
+    cells = {}
+    for name in CONTINENTS :
+        members = [i for i, cont in enumerate(continents) if cont == name]
+        width = max(1, math.isqrt(len(members)))
+        for n, i in enumerate(members) :
+            cells[name, divmod(n, width)] = i
+    islands = {i for i in range(count) if rng.random() < 0.2}
+
+    countries = []
+    for i in range(count) :
+        cca3 = code(i)
+        val = {'name' : {'common' : f'Country {cca3}',
+                         'official' : f'Republic of Country {cca3}'},
+               'cca3' : cca3,
+               'flag' : f'F{cca3}',
+               'flags' : {'png' : f'https://flags.invalid/{i % FLAG_VARIETY}.png'},
+               'continents' : [continents[i]],
+               'area' : float(round(rng.lognormvariate(10, 2.5), 2)),
+               'population' : int(rng.lognormvariate(14, 2.5)),
+               'maps' : {'googleMaps' : f'https://maps.invalid/{cca3}'}}
+        if rng.random() < 0.98 :
+            val['independent'] = rng.random() < 0.8
+
+        caps = fanOut(rng, {0 : 1, 1 : 95, 2 : 3, 3 : 1})
+        if caps :
+            val['capital'] = [f'Capital {cca3}{n or ""}' for n in range(caps)]
+
+        langs = fanOut(rng, {0 : 1, 1 : 50, 2 : 30, 3 : 10, 4 : 6, 8 : 2, 23 : 1})
+        if langs :
+            # half widely shared (skewed toward a few), half local
+            picks = {int(rng.paretovariate(1.0)) % lang_pool if rng.random() < 0.5
+                     else (i + n) % lang_pool for n in range(langs)}
+            val['languages'] = {f'l{n}' : f'Language {n}' for n in sorted(picks)}
+
+        currens = fanOut(rng, {0 : 1, 1 : 90, 2 : 9})
+        if currens :
+            picks = {0 if rng.random() < 0.15 else (i + n) % curr_pool
+                     for n in range(currens)}
+            val['currencies'] = {f'C{n}' : {'name' : f'currency {n}'} for n in picks}
+        countries.append(val)
+
+    # Neighboring grid cells share a land border, unless either is an island
+    for (cont, (row, col)), i in cells.items() :
+        if i in islands :
+            continue
+        borders = []
+        for dr, dc in ((-1, 0), (1, 0), (0, -1), (0, 1)) :
+            j = cells.get((cont, (row + dr, col + dc)))
+            if j is not None and j not in islands :
+                borders.append(code(j))
+        if borders :
+            countries[i]['borders'] = borders
+    return countries
+
+
+def makeFlags(countries) :
+    '''Return flags keyed by cca3, FLAG_VARIETY distinct .png images in all'''
+    from PIL import Image
+    images = []
+    for n in range(FLAG_VARIETY) :
+        img = Image.new('RGB', FLAG_SIZE, ((n * 37) % 256, (n * 91) % 256, (n * 53) % 256))
+        img.paste((255, 255, 255), (0, FLAG_SIZE[1] // 3, FLAG_SIZE[0], 2 * FLAG_SIZE[1] // 3))
+        out = io.BytesIO()
+        img.save(out, 'PNG')
+        images.append(out.getvalue())
+    return {val['cca3'] : images[int(val['flags']['png'].rsplit('/', 1)[1][:-4])]
+            for val in countries}
+
+
+def timed(func, *args) :
+    '''Return (result, seconds) of calling func'''
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def benchIngest(countries, flags, path) :
+    '''Build DB at path from countries, return seconds for each stage'''
+    stages = {}
+    rows, stages['normalize'] = timed(backend.normalize, countries, flags)
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    backend.applyPragmas(cur)
+    cur.execute('BEGIN')
+    _, create = timed(backend.createTables, cur)
+    _, migrate = timed(backend.migrate, cur)
+    stages['schema'] = create + migrate
+    _, stages['insert'] = timed(backend.insertRows, cur, rows)
+    _, stages['borders'] = timed(backend.writeBorders, cur)
+    _, stages['search'] = timed(backend.indexSearch, cur)
+    _, stages['aggregates'] = timed(backend.writeAggregates, cur)
+    _, stages['commit'] = timed(conn.commit)
+    conn.close()
+    return stages
+
+
+def median(values) :
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def benchQueries(path, seed = 0, repeat = REPEAT) :
+    '''Time each query path behind the front end, return median seconds'''
+    rng = random.Random(seed)
+    svc = service.CountriesService(path)
+    _, load = timed(svc.loadStore)
+    _, load_graph = timed(svc.loadGraph)
+    continent = rng.choice(svc.continents())
+    language = rng.choice(svc.languages())
+    names = rng.sample(svc.countries(), min(12, len(svc.countries())))
+    origin = max(names, key = lambda name : len(svc.landmass(name)))
+    destination = svc.landmass(origin)[-1]
+    paths = {
+        'continents' : (svc.continents,),
+        'countries worldwide' : (svc.countries,),
+        'countries by continent' : (svc.countries, continent),
+        'ranked area worldwide' : (svc.ranked, 'area'),
+        'ranked population by continent' : (svc.ranked, 'population', continent),
+        'total population' : (svc.total, 'population'),
+        'top 12 by density by continent' : (svc.top, 'density', 12, continent),
+        'sort by percentile in continent' : (svc.order, svc.countries(), 'area', True),
+        'languages' : (svc.languages,),
+        'countries by language' : (svc.languageCountries, language),
+        'cards for 12 countries' : (svc.cards, names),
+        'neighbors within 3 crossings' : (svc.neighbors, origin, 3),
+        'overland route' : (svc.route, origin, destination),
+        'search by prefix' : (svc.search, 'country a'),
+        'search by prefix in continent' : (svc.search, 'country a', continent),
+        'search languages' : (svc.searchLanguages, 'language 1'),
+        }
+    results = {'load store' : load, 'load graph' : load_graph}
+    for label, (func, *args) in paths.items() :
+        samples = []
+        for _ in range(repeat) :
+            svc.clear()     # time the query, not the memo
+            samples.append(timed(func, *args)[1])
+        results[label] = median(samples)
+    svc.close()
+    return results
+
+
+def peakRSS() :
+    '''Return peak resident memory of this process in MB, None if unknown'''
+    try :
+        import resource
+    except ImportError :     # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+def runScale(count, seed = 0) :
+    '''Run every benchmark at one scale, return dict of results'''
+    countries = generate(count, seed)
+    flags = makeFlags(countries)
+    with tempfile.TemporaryDirectory() as tmp :
+        path = os.path.join(tmp, 'bench.db')
+        ingest = benchIngest(countries, flags, path)
+        queries = benchQueries(path, seed)
+    return {'count' : count, 'ingest' : ingest, 'queries' : queries,
+            'peak_rss_mb' : peakRSS()}
+
+
+def runIsolated(count, seed = 0) :
+    '''Run one scale in a fresh process so its peak memory is its own'''
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker',
+                             str(count), '--seed', str(seed)],
+                            capture_output = True, text = True, check = True)
+    return json.loads(result.stdout)
+
+
+def report(result) :
+    '''Print results for one scale'''
+    count = result['count']
+    print(f'\n{count:,} countries')
+    for stage, seconds in result['ingest'].items() :
+        print(f'  ingest  {stage:<32}{seconds:9.4f} s {count / seconds:14,.0f} countries/s')
+    for label, seconds in result['queries'].items() :
+        print(f'  query   {label:<32}{seconds * 1000:9.3f} ms {1 / seconds:12,.0f} ops/s')
+    if result['peak_rss_mb'] is not None :
+        print(f'  peak RSS {result["peak_rss_mb"]:,.1f} MB')
+
+
+def compare(results, baseline, tolerance = TOLERANCE) :
+    '''Return (scale, measure, ratio) for measures slower than baseline by tolerance'''
+    regressions = []
+    old = {str(result['count']) : result for result in baseline}
+    for result in results :
+        before = old.get(str(result['count']))
+        if before is None :
+            continue
+        for group in ('ingest', 'queries') :
+            for label, seconds in result[group].items() :
+                then = before[group].get(label)
+                if then and seconds / then > tolerance and \
+                        seconds - then > NOISE_FLOOR :
+                    regressions.append((result['count'], label, seconds / then))
+    return regressions
+
+
+def main(scales = SCALES, seed = 0, baseline = BASELINE, save = False,
+         tolerance = TOLERANCE) :
+    '''Run all scales, report, and compare with or save the baseline'''
+    results = []
+    for count in scales :
+        results.append(runIsolated(count, seed))
+        report(results[-1])
+    if save :
+        with open(baseline, 'w') as file :
+            json.dump(results, file, indent = 1)
+        print(f'\nSaved baseline to {baseline}')
+        return 0
+    if not os.path.exists(baseline) :
+        print(f'\nNo baseline at {baseline}; run with --save-baseline to make one')
+        return 0
+    with open(baseline) as file :
+        regressions = compare(results, json.load(file), tolerance)
+    for count, label, ratio in regressions :
+        print(f'REGRESSION {count:,} countries, {label}: {ratio:.2f}x baseline')
+    if not regressions :
+        print(f'\nNo regressions against {baseline}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser(description = 'Benchmark ingest and queries')
+    parser.add_argument('--scales', type = int, nargs = '+', default = SCALES,
+                        help = 'numbers of synthetic countries to test')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--baseline', default = BASELINE,
+                        help = 'JSON file of earlier results to compare with')
+    parser.add_argument('--save-baseline', action = 'store_true',
+                        help = 'save these results as the new baseline')
+    parser.add_argument('--tolerance', type = float, default = TOLERANCE,
+                        help = 'slowdown factor that counts as a regression')
+    parser.add_argument('--worker', type = int, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker :
+        print(json.dumps(runScale(args.worker, args.seed)))
+    else :
+        raise SystemExit(main(args.scales, args.seed, args.baseline,
+                              args.save_baseline, args.tolerance))
@@ -0,0 +1,73 @@
+'''
+Tour de World Charts
+Authors: Surajit Bose, James Kang
+Copyright © 2023
+
+This project relies on the REST Countries API by Alejandro Matos:
+    - https://restcountries.com/
+    - https://gitlab.com/restcountries/restcountries
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, you can obtain one at https://mozilla.org/MPL/2.0/
+'''
+
+
+import matplotlib
+import matplotlib.style
+from matplotlib.ticker import StrMethodFormatter
+
+STYLE = 'seaborn-v0_8-whitegrid'
+
+
+def labels(desired) :
+    '''Return title, unit, and axis label for area, population, or density'''
+    title = desired.title()
+    if title == 'Area' :
+        unit = 'km\u00B2'
+        return title, unit, f'{title} ({unit})'
+    if title == 'Density' :
+        unit = 'people/km\u00B2'
+        return title, unit, f'{title} ({unit})'
+    return title, '', title
+
+
+def drawCharts(fig, desired, countries, data) :
+    '''
+    Draw box plot and bar chart of area, population, or density of countries on fig
+    Shared by the plot window and the batch reports, on any backend
+    '''
+    _, _, p_label = labels(desired)
+
+    # style applies only while the axes are drawn, not to global rcParams
+    with matplotlib.style.context(STYLE) :
+        fig.set_facecolor(matplotlib.rcParams['figure.facecolor'])
+
+        # box plot
+        box = fig.add_subplot(2, 1, 1)
+        fig.subplots_adjust(hspace = 0.5)
+        box.set_title('Box Plot', fontsize = 10, weight = 'bold')
+        box.set_xlabel(f'{p_label}', fontsize = 8)
+        box.tick_params(axis = 'both', labelsize = 8)
+        box.locator_params(axis = 'x', nbins = 6)
+        box.xaxis.set_major_formatter(StrMethodFormatter('{x:,.0f}'))
+        box.boxplot(data, orientation = 'horizontal')
+        box.set_yticks([1], ['Selected \nCountries'])
+        fig.tight_layout()
+
+        # bar chart
+        bar = fig.add_subplot(2, 1, 2)
+        fig.subplots_adjust(hspace = 1.5)
+        bar.set_title('Bar Chart', fontsize = 10, weight = 'bold')
+        bar.set_xlabel(f'{p_label}', fontsize = 8)
+        bar.set_ylabel('Countries', fontsize = 8)
+        bar.tick_params(axis = 'x', labelsize = 7.25)
+        bar.locator_params(axis = 'x', nbins = 6)
+        bar.tick_params(axis = 'y', labelsize = 8)
+        bar.xaxis.set_major_formatter(StrMethodFormatter('{x:,.0f}'))
+        bar.barh(countries, data, align = "center")
+        value_format = '{:,.1f}' if desired == 'density' else '{:,}'
+        for index, value in enumerate(data):
+            # v, i -> position to place text
+            bar.text(value + .5, index, value_format.format(value), fontsize = 7, color = 'blue', )
+        fig.tight_layout()
@@ -14,23 +14,42 @@ file, you can obtain one at https://mozilla.org/MPL/2.0/
 
 
 # import modules
+# Only what the main window needs is imported here, so it appears quickly
+# numpy, matplotlib, PIL and webbrowser are imported where they are used,
+# and warmed up on a background thread once the main window is drawn
 import tkinter as tk
 from tkinter import ttk
 import tkinter.messagebox as tkmb
-import sqlite3
-import webbrowser
 from os.path import exists
-import matplotlib
-matplotlib.use('TkAgg')
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.ticker import StrMethodFormatter
-import matplotlib.pyplot as plt
-import numpy as np
-from PIL import ImageTk, Image
 import os
+import io
+import sys
+import threading
+import importlib
+from collections import OrderedDict
+from service import CountriesService
+import tracing
+
+# Modules imported in the background after the main window is drawn
+WARM_MODULES = ['numpy', 'store', 'graph', 'PIL.Image', 'PIL.ImageTk', 'matplotlib.figure', 
+                'matplotlib.backends.backend_tkagg', 'charts', 'webbrowser']
+# Modules that must not be imported along with this file
+HEAVY_MODULES = ['numpy', 'matplotlib', 'PIL', 'store', 'graph', 'charts', 'webbrowser']
+# Budget in microseconds for importing this file, checked by checkImports
+# About 2.5 times what the import takes, 15 to 22 ms, so a regression shows
+IMPORT_BUDGET = 50000
+# How often the main window checks whether a background refresh is done
+REFRESH_POLL = 500 # ms
+
+
+def openMap(url) :
+    '''Open Google Maps link in the user's browser'''
+    import webbrowser
+    webbrowser.open(url)
 
 class LanguageDisplayWindow(tk.Toplevel) :
     '''Display the list of countries where a given language has official status'''
+    @tracing.traced
     def __init__(self, master, language, countries) :
         super().__init__(master)
         self.title(language)
@@ -62,138 +81,345 @@ class LanguageDisplayWindow(tk.Toplevel) :
         frame.grid(padx = 10, pady = 10)
 
 
+class BordersWindow(tk.Toplevel) :
+    '''
+    Display the countries within a chosen number of land crossings of a
+    country, and the shortest overland route from it to another country
+    '''
+    MAX_HOPS = 6 # most land crossings the user can ask for
+    
+    @tracing.traced
+    def __init__(self, master, country, service) :
+        super().__init__(master)
+        self.title(f'Borders of {country}')
+        self._country = country
+        self._service = service
+        
+        landmass = service.landmass(country)
+        others = [name for name in landmass if name != country]
+        if not others :
+            display_str = f'{country} has no land borders'
+        else :
+            num = len(others)
+            suffix = 'y' if num == 1 else 'ies'
+            display_str = f'{country} can reach {num} countr{suffix} overland'
+        tk.Label(self, text = display_str, font = ('Calibri', 13, 'bold'), \
+                 padx = 10, pady = 10).grid()
+        if not others :
+            return
+        
+        hopsFrame = tk.Frame(self)
+        tk.Label(hopsFrame, text = 'Land crossings : ', font = ('Calibri', 12)).grid(row = 0, column = 0)
+        self._hops = tk.Spinbox(hopsFrame, from_ = 1, to = BordersWindow.MAX_HOPS, width = 3, \
+                                state = 'readonly', command = self._showNeighbors)
+        self._hops.grid(row = 0, column = 1)
+        hopsFrame.grid(padx = 10)
+        
+        listFrame = tk.Frame(self)
+        self._lb = tk.Listbox(listFrame, height = 8, width = 40)
+        sb = tk.Scrollbar(listFrame, orient = 'vertical', command = self._lb.yview)
+        self._lb.config(yscrollcommand = sb.set)
+        self._lb.grid(row = 0, column = 0)
+        sb.grid(row = 0, column = 1, sticky = 'NS')
+        listFrame.grid(padx = 10, pady = 5)
+        
+        routeFrame = tk.Frame(self)
+        tk.Label(routeFrame, text = 'Overland route to : ', font = ('Calibri', 12)).grid(row = 0, column = 0)
+        self._destination = ttk.Combobox(routeFrame, values = others, state = 'readonly')
+        self._destination.bind('<<ComboboxSelected>>', self._showRoute)
+        self._destination.grid(row = 0, column = 1)
+        self._route_str = tk.StringVar()
+        tk.Label(routeFrame, textvariable = self._route_str, font = ('Calibri', 12), \
+                 wraplength = 350, justify = 'left').grid(row = 1, columnspan = 2, sticky = 'W', pady = 5)
+        routeFrame.grid(padx = 10, pady = 10)
+        
+        self._showNeighbors()
+        
+        
+    @tracing.traced
+    def _showNeighbors(self) :
+        '''List the countries within the chosen number of land crossings'''
+        neighbors = self._service.neighbors(self._country, int(self._hops.get()))
+        self._lb.delete(0, tk.END)
+        self._lb.insert(tk.END, *(f'{hops}   {name}' for name, hops in neighbors))
+        
+        
+    @tracing.traced
+    def _showRoute(self, event) :
+        '''Show the shortest overland route to the chosen country'''
+        route = self._service.route(self._country, self._destination.get())
+        crossings = len(route) - 1
+        suffix = '' if crossings == 1 else 's'
+        self._route_str.set(f'{crossings} crossing{suffix} : ' + ' \u2192 '.join(route))
+
+
+class FlagImages :
+    '''
+    LRU cache of flag thumbnails as Tk images, keyed by country code
+    Thumbnails are made at ingest, so they are only decoded here, never resized
+    '''
+    def __init__(self, maxsize = 64) :
+        self._maxsize = maxsize
+        self._images = OrderedDict()
+        
+        
+    def get(self, code, thumb) :
+        '''Return PhotoImage for country, decoding thumb from memory if needed'''
+        try :
+            self._images.move_to_end(code)
+        except KeyError :
+            from PIL import Image, ImageTk
+            self._images[code] = ImageTk.PhotoImage(Image.open(io.BytesIO(thumb)))
+            if len(self._images) > self._maxsize :
+                self._images.popitem(last = False)
+        return self._images[code]
+    
+    
+    def clear(self) :
+        '''Drop every image, as a new DB may have changed flags'''
+        self._images.clear()
+
+
 class CountryCardWindow(tk.Toplevel) :
-    '''Class to display individual cards, gets called for every country selected'''
-    def __init__(self, master, selected_countries) :
+    '''
+    Class to display individual cards, one notebook tab for every country selected
+    Only the first tab is built up front; others are built when first selected,
+    from data fetched in the background while the first tab is on screen
+    '''
+    @tracing.traced
+    def __init__(self, master, names, codes, flag_images) :
         super().__init__(master)
         self.title('Country Cards')
         self.resizable(False, False)
-
-        # create notebook
-        card_notebook = ttk.Notebook(self)
-
-        for country in selected_countries:
-            name, flag, official, capitals, pop, area, langs, currency, continent, url, code = country
-            prompt_str = tk.StringVar()
-            prompt_str.set(f'General Information for {name}')
-            cap_label = 'Capital'
-            if ', ' in capitals :
-                cap_label += 's'
-            lang_label = 'Language'
-            if ', ' in langs :
-                lang_label += 's'
-            currens_label = 'Currency'
-            if ', ' in currency :
-                currens_label = 'Currencies'
-                
-            with open('wflag.png', 'wb') as file :
-                file.write(flag)
-            img = Image.open('wflag.png')
-            img = img.resize((40, 30), Image.LANCZOS)
-            img = ImageTk.PhotoImage(img)
-        
-            # create tab Frame to put into the window
-            frame = tk.Frame(card_notebook)
-            frame.image = img
-            tk.Label(frame, textvariable = prompt_str, font = ('Calibri', 13)).grid()
-            tk.Label(frame, image = frame.image).grid(pady = 10)
-            tk.Label(frame, text = official, font = ('Calibri', 14), fg = 'blue').grid()
-            tk.Label(frame, text = f'{cap_label}: ' + capitals, font = ('Calibri', 13), fg = 'blue').grid()
-            tk.Label(frame, text = f'Population: {pop : ,}', font = ('Calibri', 13), fg = 'blue').grid()
-            tk.Label(frame, text = f'Area: {area : ,} km\u00B2', font = ('Calibri', 13), fg = 'blue').grid()
-            tk.Label(frame, text = f'{lang_label}: ' + langs, font = ('Calibri', 13), fg = 'blue', wraplength = 250,
-                     justify = 'center').grid()
-            tk.Label(frame, text = f'{currens_label}: ' + currency.title(), font = ('Calibri', 13), fg = 'blue').grid()
-            tk.Label(frame, text = 'Continent: ' + continent, font = ('Calibri', 13), fg = 'blue').grid()
-            tk.Button(frame, text = 'Visit on Google Maps', fg = 'blue', font = ('Calibri', 12),
-                      command = lambda : webbrowser.open(url)).grid(pady = 20)
-
-            frame.grid()
+        self._names = names
+        self._flag_images = flag_images
+        self._cards = master._service.cards(names[:1])
+        self._built = set()
+
+        # create notebook with an empty frame for each tab
+        self._notebook = ttk.Notebook(self)
+        for code in codes :
+            frame = tk.Frame(self._notebook)
             frame.grid_columnconfigure(0, weight = 1)
-
-            # adds each tab frame to the Noteboosk
-            card_notebook.add(frame, text = f'{code}')
-
-        card_notebook.grid()
+            self._notebook.add(frame, text = f'{code}')
+        self._notebook.bind('<<NotebookTabChanged>>', self._showTab)
+        self._notebook.grid()
+        self._showTab()
+        
+        if len(names) > 1 :
+            threading.Thread(target = self._prefetch, args = (names[1:],),
+                             daemon = True).start()
+        
+        
+    @tracing.traced
+    def _prefetch(self, names) :
+        '''Fetch data for hidden tabs on a worker thread'''
+        # sqlite3 connections can't be shared across threads, so open another
+        service = CountriesService(MainWindow.COUNTRIES_DB)
+        try :
+            self._cards.update(service.cards(names))
+        finally :
+            service.close()
+            
+            
+    @tracing.traced
+    def _showTab(self, event = None) :
+        '''Build the selected tab the first time it is shown'''
+        index = self._notebook.index('current')
+        if index in self._built :
+            return
+        name = self._names[index]
+        if name not in self._cards :    # prefetch hasn't got here yet
+            self._cards.update(self.master._service.cards([name]))
+        frame = self.nametowidget(self._notebook.tabs()[index])
+        self._buildTab(frame, name, *self._cards[name])
+        self._built.add(index)
+
+
+    def _buildTab(self, frame, name, flag, official, capitals, pop, area, langs, currency, continent, url, code) :
+        '''Fill a tab frame with the general information for one country'''
+        prompt_str = tk.StringVar(frame)
+        prompt_str.set(f'General Information for {name}')
+        cap_label = 'Capital'
+        if ', ' in capitals :
+            cap_label += 's'
+        lang_label = 'Language'
+        if ', ' in langs :
+            lang_label += 's'
+        currens_label = 'Currency'
+        if ', ' in currency :
+            currens_label = 'Currencies'
+            
+        # frame keeps a reference so an image evicted from the cache stays alive
+        frame.image = self._flag_images.get(code, flag)
+        frame.prompt_str = prompt_str
+        tk.Label(frame, textvariable = prompt_str, font = ('Calibri', 13)).grid()
+        tk.Label(frame, image = frame.image).grid(pady = 10)
+        tk.Label(frame, text = official, font = ('Calibri', 14), fg = 'blue').grid()
+        tk.Label(frame, text = f'{cap_label}: ' + capitals, font = ('Calibri', 13), fg = 'blue').grid()
+        tk.Label(frame, text = f'Population: {pop : ,}', font = ('Calibri', 13), fg = 'blue').grid()
+        tk.Label(frame, text = f'Area: {area : ,} km\u00B2', font = ('Calibri', 13), fg = 'blue').grid()
+        tk.Label(frame, text = f'{lang_label}: ' + langs, font = ('Calibri', 13), fg = 'blue', wraplength = 250,
+                 justify = 'center').grid()
+        tk.Label(frame, text = f'{currens_label}: ' + currency.title(), font = ('Calibri', 13), fg = 'blue').grid()
+        tk.Label(frame, text = 'Continent: ' + continent, font = ('Calibri', 13), fg = 'blue').grid()
+        tk.Button(frame, text = 'Visit on Google Maps', fg = 'blue', font = ('Calibri', 12),
+                  command = lambda : openMap(url)).grid(pady = 20)
+        
+        
+class FigurePool :
+    '''
+    Reusable matplotlib Figures for plot windows
+    Figures are standalone, never registered with pyplot, so nothing holds on
+    to them once a window is closed and its figure is cleared and put back
+    '''
+    def __init__(self, maxsize = 4) :
+        self._maxsize = maxsize
+        self._free = []
         
         
+    def acquire(self) :
+        '''Return a blank figure, reusing a released one if available'''
+        if self._free :
+            return self._free.pop()
+        from matplotlib.figure import Figure
+        return Figure()
+    
+    
+    def release(self, fig) :
+        '''Clear figure, detach it from its Tk canvas, and keep it for reuse'''
+        from matplotlib.backend_bases import FigureCanvasBase
+        fig.clear()
+        FigureCanvasBase(fig)   # drops the reference to the Tk canvas
+        if len(self._free) < self._maxsize :
+            self._free.append(fig)
+
+
 class PlotWindow(tk.Toplevel):
-    '''Class to display boxplot and bar chart of area or population'''
-    def __init__(self, master, desired, countries, data):
+    '''
+    Class to display boxplot and bar chart of area, population, or density
+    metrics is a dict of metric to the values of countries, in order; the 
+    window opens on desired, and can be switched to any other metric
+    '''
+    @tracing.traced
+    def __init__(self, master, desired, countries, metrics, figures):
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
         super().__init__(master)
         self.title('Plot and Analysis')
         self.resizable(False, False)
-        
-        t_label = desired.title()
-        if t_label == 'Area' :
-            a_label = 'km\u00B2' 
-            p_label = f'{t_label} ({a_label})'
-        else :
-            a_label = ''
-            p_label = t_label
             
-        fig = plt.figure()
-        plt.style.use("seaborn-v0_8-whitegrid")
-
-        tk.Label(self, text = f'{t_label} of Selected Countries', font = ('Calibri', 15, 'bold')).grid(pady = 8)
+        self._countries = countries
+        self._metrics = metrics
+        self._figures = figures
+        self._fig = figures.acquire()
+        self._title_str = tk.StringVar(self)
+        self._names_str = tk.StringVar(self)
+        self._stat_strs = [tk.StringVar(self) for _ in range(6)]
+
+        tk.Label(self, textvariable = self._title_str, font = ('Calibri', 15, 'bold')).grid(pady = 8)
+
+        sortFrame = tk.Frame(self)
+        tk.Label(sortFrame, text = 'Sort by', font = ('Calibri', 12)).grid(row = 0, column = 0)
+        self._metric = ttk.Combobox(sortFrame, values = list(metrics), state = 'readonly', width = 12)
+        self._metric.set(desired)
+        self._metric.bind('<<ComboboxSelected>>', lambda event : self._show(self._metric.get()))
+        self._metric.grid(row = 0, column = 1, padx = 5)
+        sortFrame.grid()
 
         info_frame = tk.Frame(self)
-        tk.Label(info_frame, text = ', '.join(countries), font = ('Calibri', 13, 'bold'), wraplength = 425).grid(columnspan = 2, pady = 3)
-        tk.Label(info_frame, text = f'Total: {np.sum(np.array(data)):,} {a_label}', font = ('Calibri', 13)).grid(column = 0, sticky = 'w')
-        tk.Label(info_frame, text = f'Min: {np.min(np.array(data)):,} {a_label}', font = ('Calibri', 13)).grid(column = 0, sticky = 'w')
-        tk.Label(info_frame, text = f'1st Quartile: {np.quantile(np.array(data), .25):,.0f} {a_label}', font = ('Calibri', 13)).grid(column = 0, sticky = 'w')
-        tk.Label(info_frame, text = f'Median: {np.median(np.array(data)):,.0f} {a_label}', font = ('Calibri', 13)).grid(row = 1, column = 1, sticky = 'w')
-        tk.Label(info_frame, text = f'3rd Quartile: {np.quantile(np.array(data), .75):,.0f} {a_label}', font = ('Calibri', 13)).grid(row = 2, column = 1, sticky = 'w')
-        tk.Label(info_frame, text = f'Max: {max(data):,} {a_label}', font = ('Calibri', 13)).grid(row = 3, column = 1, sticky = 'w')
+        tk.Label(info_frame, textvariable = self._names_str, font = ('Calibri', 13, 'bold'), wraplength = 425).grid(columnspan = 2, pady = 3)
+        # total, min, and 1st quartile on the left; median, 3rd quartile, and max on the right
+        for i, stat_str in enumerate(self._stat_strs) :
+            tk.Label(info_frame, textvariable = stat_str, font = ('Calibri', 13)).grid(row = 1 + i % 3, column = i // 3, sticky = 'w')
         info_frame.grid(padx = 5, pady = 8)
 
-        # box plot
-        plt.subplot(2, 1, 1)
-        plt.subplots_adjust(hspace = 0.5)
-        plt.title('Box Plot', fontsize = 10, weight = 'bold')
-        plt.xlabel(f'{p_label}', fontsize = 8)
-        plt.yticks(fontsize = 8)
-        plt.xticks(fontsize = 8)
-        plt.locator_params(axis = 'x', nbins = 6)
-        plt.gca().xaxis.set_major_formatter(StrMethodFormatter('{x:,.0f}'))
-        plt.boxplot(data, labels = ['Selected \nCountries'], vert = False)
-        fig.tight_layout()
-
-        # bar chart
-        plt.subplot(2, 1, 2)
-        plt.subplots_adjust(hspace = 1.5)
-        plt.title('Bar Chart', fontsize = 10, weight = 'bold')
-        plt.xlabel(f'{p_label}', fontsize = 8)
-        plt.ylabel('Countries', fontsize = 8)
-        plt.xticks(fontsize = 7.25)
-        plt.locator_params(axis = 'x', nbins = 6)
-        plt.yticks(fontsize = 8)
-        plt.gca().xaxis.set_major_formatter(StrMethodFormatter('{x:,.0f}'))
-        plt.barh(countries, data, align = "center")
-        for index, value in enumerate(data):
-            # v, i -> position to place text
-            plt.text(value + .5, index, str(f'{value:,}'), fontsize = 7, color = 'blue', )
-        fig.tight_layout()
-
-        canvas = FigureCanvasTkAgg(fig, master = self)
-        canvas.get_tk_widget().grid()
-        canvas.draw()
+        self._canvas = FigureCanvasTkAgg(self._fig, master = self)
+        self._canvas.get_tk_widget().grid()
 
         # button to close
         tk.Button(self, text = 'Close', command = self.destroy).grid(pady = 8)
+        
+        self._show(desired)
+        
+        
+    @tracing.traced
+    def _show(self, metric) :
+        '''Chart the countries by metric, largest first'''
+        import charts
+        from store import describe
+        values = self._metrics[metric]
+        # Countries with no land area have no density to show
+        order = [i for i in self.master._service.order(self._countries, metric) 
+                 if values[i] is not None]
+        countries = [self._countries[i] for i in order]
+        data = [values[i] for i in order]
+        
+        t_label, a_label, _ = charts.labels(metric)
+        self._title_str.set(f'{t_label} of Selected Countries')
+        self._names_str.set(', '.join(countries))
+        stats = describe(data)
+        if metric == 'density' :
+            # A sum of densities means nothing, so show density of them all together
+            area = sum(self._metrics['area'][i] for i in order)
+            pop = sum(self._metrics['population'][i] for i in order)
+            first = f'Overall: {pop / area:,.1f} {a_label}'
+            value_format = '{:,.1f}'
+        else :
+            first = f'Total: {stats["sum"]:,} {a_label}'
+            value_format = '{:,}'
+        texts = [first, 
+                 f'Min: {value_format.format(stats["min"])} {a_label}',
+                 f'1st Quartile: {stats["q1"]:,.0f} {a_label}',
+                 f'Median: {stats["median"]:,.0f} {a_label}',
+                 f'3rd Quartile: {stats["q3"]:,.0f} {a_label}',
+                 f'Max: {value_format.format(stats["max"])} {a_label}']
+        for stat_str, text in zip(self._stat_strs, texts) :
+            stat_str.set(text)
+        
+        self._fig.clear()
+        charts.drawCharts(self._fig, metric, countries, data)
+        with tracing.span('PlotWindow.draw', __name__) :
+            self._canvas.draw()
+        
+        
+    def destroy(self) :
+        '''Tear down canvas and hand figure back to the pool'''
+        if self._fig is not None :
+            self._canvas.get_tk_widget().destroy()
+            self._figures.release(self._fig)
+            self._fig = self._canvas = None
+        super().destroy()
 
 
 class DialogWindow(tk.Toplevel) :
     '''
     Class to interact with the user and display a listbox for user to get selection of countries
+    If search is given, typing in the search box narrows the listbox to the items search returns
+    If sorts is given, a dict of name to list of data indices in that order, the
+    list can be reordered by any of them; the first is the order of data itself
     '''
-    def __init__(self, master, desired, prompt, data, mini, maxi, npstr) :
+    SEARCH_DELAY = 150 # ms after the last keystroke before the list is filtered
+    
+    @tracing.traced
+    def __init__(self, master, desired, prompt, data, mini, maxi, npstr, search = None, sorts = None) :
         super().__init__(master)
         self.grab_set()
         self.focus_set()
         self.transient(master)
         self._choice = (-1, )
         
+        # Listbox rows are the items of data at the indices in self._shown
+        # Choices are kept as data indices so they survive a new search
+        self._data = data
+        self._search = search
+        self._sorts = sorts
+        self._order = range(len(data))
+        self._rank = None   # position of each data index in _order, if reordered
+        self._shown = self._order
+        self._selected = set()
+        self._positions = None
+        self._pending = None
+        
         self.prompt_str = tk.StringVar()
         self.prompt_str.set(prompt)
         
@@ -201,29 +427,44 @@ class DialogWindow(tk.Toplevel) :
         self.numpy_str.set(npstr)
 
         self.selected_count = tk.StringVar()
+        
+        self.search_str = tk.StringVar()
 
         self.minsize(415, 250)
-        self.maxsize(550, 300)
+        self.maxsize(550, (300 if search is None else 340) + (0 if sorts is None else 30))
         self.grid_columnconfigure(0, weight = 1)
         self.grid_rowconfigure(0, weight = 1)
 
         promptFrame = tk.Frame(self)
-        tk.Label(promptFrame, textvariable = self.prompt_str, font = ('Calibri', 13)).grid()
+        tk.Label(promptFrame, textvariable = self.prompt_str, font = ('Calibri', 13)).grid(columnspan = 2)
+        if sorts is not None :
+            tk.Label(promptFrame, text = 'Sort by', font = ('Calibri', 12)).grid(row = 1, column = 0, sticky = 'e')
+            self._sort = ttk.Combobox(promptFrame, values = list(sorts), state = 'readonly', width = 28)
+            self._sort.current(0)
+            self._sort.bind('<<ComboboxSelected>>', self._reorder)
+            self._sort.grid(row = 1, column = 1, sticky = 'w', padx = 5, pady = 3)
         promptFrame.grid()
 
         listboxFrame = tk.Frame(self)
-        how_many = 'single' if desired in ['continent', 'language'] else 'multiple'
-        self._lb = tk.Listbox(listboxFrame, height = 8, selectmode = how_many)
+        how_many = 'single' if desired in ['continent', 'language', 'borders'] else 'multiple'
+        # exportselection off, or selecting text in the search box clears the choice
+        self._lb = tk.Listbox(listboxFrame, height = 8, selectmode = how_many, exportselection = False)
+        self._lb.bind('<<ListboxSelect>>', self._update_listbox)
+
+        if search is not None :
+            entry = tk.Entry(listboxFrame, textvariable = self.search_str)
+            entry.grid(row = 0, column = 0, sticky = 'EW', pady = 3)
+            self.search_str.trace_add('write', self._scheduleSearch)
+            entry.focus_set()
 
         if desired != 'continent':
             self._sb = tk.Scrollbar(listboxFrame, orient = 'vertical', command = self._lb.yview)
             self._lb.config(yscrollcommand = self._sb.set)
             self._sb.grid(row = 1, column = 1, sticky = 'NS')
             tk.Label(listboxFrame, textvariable = self.numpy_str, font = ('Calibri', 12), pady = 3).grid()
-            if desired != 'language':
+            if desired not in ['language', 'borders']:
                 self.selected_count.set('Countries Selected: 0')
                 tk.Label(listboxFrame, textvariable = self.selected_count, font = ('Calibri', 12), pady = 3).grid()
-                self._lb.bind('<<ListboxSelect>>', self._update_listbox)
 
 
         self._lb.insert(tk.END, *data)
@@ -236,25 +477,79 @@ class DialogWindow(tk.Toplevel) :
         
     
     def _update_listbox(self, event) :
-        self.selected_count.set(f'Countries Selected: {len(self._lb.curselection())}')
+        chosen = {self._shown[row] for row in self._lb.curselection()}
+        if self._lb.cget('selectmode') == 'single' :
+            self._selected = chosen
+        else :
+            # Keep choices hidden by the current search
+            self._selected = (self._selected - set(self._shown)) | chosen
+        self.selected_count.set(f'Countries Selected: {len(self._selected)}')
+        
+        
+    def _scheduleSearch(self, *args) :
+        '''Filter the list once typing pauses, rather than on every keystroke'''
+        if self._pending is not None :
+            self.after_cancel(self._pending)
+        self._pending = self.after(DialogWindow.SEARCH_DELAY, self._filter)
+        
+        
+    @tracing.traced
+    def _reorder(self, event) :
+        '''Show the list in the chosen order, keeping the search and the choices'''
+        self._order = self._sorts[self._sort.get()]
+        self._rank = [0] * len(self._data)
+        for position, i in enumerate(self._order) :
+            self._rank[i] = position
+        self._filter()
+        
+        
+    @tracing.traced
+    def _filter(self) :
+        '''Show only the items the search returns, in the current order'''
+        self._pending = None
+        text = self.search_str.get()
+        if text.strip() and self._search is not None :
+            if self._positions is None :
+                self._positions = {item : i for i, item in enumerate(self._data)}
+            found = self._search(text)
+            key = None if self._rank is None else self._rank.__getitem__
+            self._shown = sorted((self._positions[item] for item in found 
+                                  if item in self._positions), key = key)
+        else :
+            self._shown = self._order
+        self._lb.delete(0, tk.END)
+        self._lb.insert(tk.END, *(self._data[i] for i in self._shown))
+        for row, i in enumerate(self._shown) :
+            if i in self._selected :
+                self._lb.selection_set(row)
         
         
+    @tracing.traced
     def _setChoice(self, desired, mini, maxi) :
         
         if desired in ['continent', 'language']: 
             err = f'Please choose a {desired}'
+        elif desired == 'borders' :
+            err = 'Please choose a country'
         else :
             err = f'Please choose between {mini} and {maxi} countries'
             
-        choice = self._lb.curselection()
+        choice = tuple(sorted(self._selected))
         
         if not mini <= len(choice) <= maxi :
             tkmb.showerror('Error', err, parent = self)
             self._lb.selection_clear(0, tk.END)
-            choice = self._lb.curselection()
+            self._selected.clear()
+            self.selected_count.set('Countries Selected: 0')
         else :
             self._choice = choice
             self.destroy()
+            
+            
+    def destroy(self) :
+        if self._pending is not None :
+            self.after_cancel(self._pending)
+        super().destroy()
 
 
     @property
@@ -273,10 +568,11 @@ class MainWindow(tk.Tk) :
     COUNTRIES_DB = 'countries.db' # database from which window displays data
     MIN_COUNTRIES = 5 # minimum number of countries to display
     MAX_COUNTRIES = 12 # maximum number of countries to display
+    MAX_CARDS = 12 # maximum number of country cards, built lazily
 
     def __init__(self) :
         '''
-        Create database connection and cursor. Instantiate main window
+        Create query service for the database. Instantiate main window
         with all the widgets.
         '''
         super().__init__()
@@ -285,8 +581,9 @@ class MainWindow(tk.Tk) :
             tkmb.showerror(f'Cannot open {MainWindow.COUNTRIES_DB}', parent = self)
             raise SystemExit
             
-        self._conn = sqlite3.connect(MainWindow.COUNTRIES_DB)
-        self._curr = self._conn.cursor()
+        self._service = CountriesService(MainWindow.COUNTRIES_DB)
+        self._flag_images = FlagImages()
+        self._figures = FigurePool()
 
         self.attributes('-topmost', 'true')
         self.title('Tour de World')
@@ -308,20 +605,90 @@ class MainWindow(tk.Tk) :
         tk.Label(buttonFrame, text = 'Search Countries Data By : ', font = ('Calibri', 13)).grid(row = 0, columnspan = 3, pady = 10)
         tk.Button(buttonFrame, text = 'Area', command = lambda: self.getContinentChoice('area')).grid(row = 1, column = 0, pady = 2, padx = 5)
         tk.Button(buttonFrame, text = 'Population', command = lambda: self.getContinentChoice('population')).grid(row = 1, column = 1, pady = 2, padx = 5)
+        tk.Button(buttonFrame, text = 'Borders', command = self._handleBorders).grid(row = 1, column = 2, pady = 2, padx = 5)
         tk.Button(buttonFrame, text = 'Language', command = self._handleLanguage).grid(row = 2, column = 0, pady = 2, padx = 5)
         tk.Button(buttonFrame, text = 'General Info', command = lambda: self.getContinentChoice('general')).grid(row = 2, column = 1, pady = 2, padx = 5)
         buttonFrame.grid(pady = 20)
 
         self.protocol('WM_DELETE_WINDOW', self.mainWinClose)
+        
+        # Countries, areas and populations are read once and kept in memory
+        # Loading them needs numpy, so it happens after the window is drawn
+        self._warm_thread = threading.Thread(target = self._warmUp, daemon = True)
+        self.after_idle(self.after, 1, self._startWarmUp)
+
+
+    def _startWarmUp(self) :
+        '''Start background loading, unless a click has already started it'''
+        if self._warm_thread.ident is None :
+            self._warm_thread.start()
+            
+            
+    @tracing.traced
+    def _warmUp(self) :
+        '''Load country store and import heavy modules on a worker thread'''
+        self._service.loadStore()
+        for module in WARM_MODULES :
+            importlib.import_module(module)
+            
+            
+    @tracing.traced
+    def _waitForStore(self) :
+        '''Wait for the background load, which the service would otherwise redo'''
+        self._startWarmUp()
+        self._warm_thread.join()
 
 
+    def startRefresh(self, refresh, install = None) :
+        '''
+        Call refresh on a worker thread while the window stays usable
+        refresh builds a new DB and returns True if it did. The service is
+        then reopened on the new DB, calling install first if given, to
+        swap in a build the OS would not replace while the DB was open
+        '''
+        def work() :
+            try :
+                self._refreshed = refresh()
+            except Exception as e :
+                self._refreshed = e
+        self._refreshed = None
+        self._refresh_thread = threading.Thread(target = work, daemon = True)
+        self._refresh_thread.start()
+        self.after(REFRESH_POLL, self._checkRefresh, install)
+        
+        
+    def _checkRefresh(self, install) :
+        '''Reopen the service on the new DB once the refresh is done'''
+        if self._refresh_thread.is_alive() :
+            self.after(REFRESH_POLL, self._checkRefresh, install)
+            return
+        if isinstance(self._refreshed, Exception) :
+            # Keep showing the last good DB
+            print(f'Could not refresh {MainWindow.COUNTRIES_DB}: {self._refreshed}', file = sys.stderr)
+            return
+        if not self._refreshed :
+            return
+        # A store still loading would come from the old DB
+        with tracing.span('MainWindow.swapDB', __name__) :
+            if self._warm_thread.ident is not None :
+                self._warm_thread.join()
+            self._service.close()
+            if install is not None :
+                install()
+            self._service.reopen()
+            # Cards already open keep their own references to their images
+            self._flag_images.clear()
+        self._warm_thread = threading.Thread(target = self._warmUp, daemon = True)
+        self._warm_thread.start()
+
+
+    @tracing.traced
     def getContinentChoice(self, desired) :
         '''
         Generate sorted list of appropriate countries based on user choice
         Pass list on to method to get user's choice of countries
         '''       
-        self._curr.execute('SELECT name FROM Continents ORDER BY name')
-        continents = list(zip(['Worldwide'], *self._curr.fetchall()))[0]
+        continents = ('Worldwide', *self._service.continents())
         
         prompt = 'What part of the world would you like to tour?'
         region = self._getChoice('continent', prompt, continents)[0]
@@ -329,154 +696,138 @@ class MainWindow(tk.Tk) :
         if region == -1 :   # User closed window without choosing
             return        
          
-        cmd = self._getCommand(desired, region)   
         if region :     # User chose specific continent
             locale = continents[region]
             locale_str = f'in {locale}'
-            self._curr.execute(cmd, (locale,))
         else :
+            locale = None
             locale_str = 'Worldwide'
-            self._curr.execute(cmd)
-            
-        data = list(zip(*self._curr.fetchall()))[0]
          
+        self._waitForStore()
+        search = lambda text : self._service.search(text, locale)
         if desired == 'general' :
             mini = 1
-            maxi = MainWindow.MIN_COUNTRIES
-            self._handleGeneral(data, locale_str, desired, mini, maxi)
+            maxi = MainWindow.MAX_CARDS
+            data = self._service.countries(locale)
+            sorts = self._sortOptions(data, 'name', locale is None)
+            self._handleGeneral(data, locale_str, desired, mini, maxi, search, sorts)
         else :
             mini = MainWindow.MIN_COUNTRIES
             maxi = MainWindow.MAX_COUNTRIES
-            self._handleAreaOrPop(data, locale_str, desired, mini, maxi)
+            ranked = self._service.ranked(desired, locale)
+            total = self._service.total(desired, locale)
+            sorts = self._sortOptions([name for name, _ in ranked], desired, locale is None)
+            self._handleAreaOrPop(ranked, total, locale_str, desired, mini, maxi, search, sorts)
+    
+    
+    def _sortOptions(self, names, default, worldwide) :
+        '''
+        Return orders a dialog listing names can offer, as lists of indices 
+        into names, starting with default, the order names are already in
+        Worldwide lists can also be sorted by standing within each continent
+        '''
+        from store import METRICS
+        sorts = {default : range(len(names))}
+        for key in ['name', *METRICS] :
+            if key != default :
+                sorts[key] = self._service.order(names, key)
+        if worldwide :
+            for metric in METRICS :
+                sorts[f'{metric} percentile in continent'] = \
+                    self._service.order(names, metric, percentile = True)
+        return sorts
     
             
-    def _handleAreaOrPop(self, data, locale_str, desired, mini, maxi) :
+    @tracing.traced
+    def _handleAreaOrPop(self, ranked, total, locale_str, desired, mini, maxi, search = None, sorts = None) :
         '''Get list of countries with population or area data'''
-        cont_data = [self._curr.execute(f'''SELECT {desired} from Countries 
-                WHERE name = ?''', (country,)).fetchone()[0] for country in data]
-        cont_array = np.array(cont_data)
+        data = [name for name, _ in ranked]
         prompt = f'Select between {mini} and {maxi} countries {locale_str} (sorted by {desired})'
-        label_var = f'Total Countries : {len(cont_array)}    Total {desired} : {np.sum(cont_array) : ,} '
+        label_var = f'Total Countries : {len(ranked)}    Total {desired} : {total : ,} '
         if desired == 'area' :
             label_var += ' km\u00B2'
-        choices = self._getChoice(desired, prompt, data, label_var, mini, maxi)
+        choices = self._getChoice(desired, prompt, data, label_var, mini, maxi, search, sorts)
         if choices[0] == -1 :  # user closed without choosing
             return
-        self._launchCountries(desired, data, choices)
+        self._launchCountries(desired, ranked, choices)
 
 
-    def _handleGeneral(self, data, locale_str, desired, mini, maxi) :
+    @tracing.traced
+    def _handleGeneral(self, data, locale_str, desired, mini, maxi, search = None, sorts = None) :
         '''Get list of countries with general info'''
         prompt = f'Select between {mini} and {maxi} countries (sorted alphabetically)'
         label_var = f'Total countries {locale_str} : {len(data)}'
-        choices = self._getChoice(desired, prompt, data, label_var, mini, maxi)
+        choices = self._getChoice(desired, prompt, data, label_var, mini, maxi, search, sorts)
         if choices[0] == -1 : # user closed without choosing
             return
         self._launchCard(data, choices)
     
     
+    @tracing.traced
     def _handleLanguage(self):
         '''
         Generate sorted list of languages
         Get user's choice of language
         Display list of countries where that language is official
         '''
-        self._curr.execute('''SELECT name FROM Languages 
-                    WHERE name != 'None' ORDER BY name''')
-        langs = list(zip(*self._curr.fetchall()))[0]
+        langs = self._service.languages()
         prompt = 'Select a language (sorted alphabetically)'
         label_var = f'Number of Official Languages : {len(langs)}'
-        choice = self._getChoice('language', prompt, langs, label_var)[0]
+        choice = self._getChoice('language', prompt, langs, label_var, 
+                                 search = self._service.searchLanguages)[0]
         if choice == -1 : # user closed without choosing
             return
         selected = langs[choice]
-        self._curr.execute('''SELECT C.mflag, C.name FROM Countries C
-                    INNER JOIN Count_Lang_Jn CL on C.id = CL.Country
-                    INNER JOIN Languages L on CL.language = L.id
-                    WHERE L.name = ? ORDER BY C.name''', (selected,))
-        countries_list = list(self._curr.fetchall())
+        countries_list = self._service.languageCountries(selected)
         LanguageDisplayWindow(self, selected, countries_list)
 
+
+    
+    @tracing.traced
+    def _handleBorders(self) :
+        '''
+        Generate sorted list of countries
+        Get user's choice of country
+        Display its neighbors and overland routes to other countries
+        '''
+        self._waitForStore()
+        countries = self._service.countries()
+        prompt = 'Select a country (sorted alphabetically)'
+        label_var = f'Total Countries : {len(countries)}'
+        choice = self._getChoice('borders', prompt, countries, label_var, 
+                                 search = self._service.search, 
+                                 sorts = self._sortOptions(countries, 'name', True))[0]
+        if choice == -1 : # user closed without choosing
+            return
+        BordersWindow(self, countries[choice], self._service)
         
 
-    def _getCommand(self, desired, region) :
-        '''Get approppriate SQL command to run on database depending on user choice'''
-        if desired == 'general' :
-            if not region :
-                # User wants general info worldwide
-                return 'SELECT name FROM Countries ORDER BY name'
-            # user wants general info for specific region
-            return '''SELECT Countries.name FROM Countries JOIN Continents
-                    ON Countries.continent = Continents.id
-                    WHERE Continents.name = ? 
-                    ORDER BY Countries.name'''
-        if not region :
-            # user wants area or pop info worldwide
-            return f'SELECT name from Countries ORDER BY {desired} DESC'
-        # user wants area or pop info for specific region
-        return f'''SELECT Countries.name FROM Countries JOIN Continents
-                ON Countries.continent = Continents.id
-                WHERE Continents.name = ? ORDER BY Countries.{desired} DESC'''
-
-
-    def _getChoice(self, desired, prompt, data, label_var = '', mini = 1, maxi = 1) :
+    @tracing.traced
+    def _getChoice(self, desired, prompt, data, label_var = '', mini = 1, maxi = 1, search = None, sorts = None) :
         '''Get user's choice of which continent or countries to see'''
-        dwin = DialogWindow(self, desired, prompt, data, mini, maxi, label_var)
+        dwin = DialogWindow(self, desired, prompt, data, mini, maxi, label_var, search, sorts)
         self.wait_window(dwin)
         choice = dwin.chosen
         return choice
 
 
-    def _launchCountries(self, desired, countries, choices) :
+    @tracing.traced
+    def _launchCountries(self, desired, ranked, choices) :
         '''Display chosen countries by area or population'''
-        # store countries and data in list to be used for bar chart
-        plot_countries = []
-        plot_data = []
-        # goes through the indices of the curselection of the countries
-        for choice in choices :
-            plot_countries.append(countries[choice])
-            self._curr.execute(f'''SELECT {desired} FROM Countries 
-                                    WHERE name = ?''', (countries[choice],))
-            plot_data.append(self._curr.fetchone()[0])
+        # choices are indices into the ranked list given to the listbox
+        plot_countries = [ranked[choice][0] for choice in choices]
+        # every metric, so the plot window can switch between them
+        plot_data = self._service.metrics(plot_countries)
             
-        PlotWindow(self, desired, plot_countries, plot_data)
+        PlotWindow(self, desired, plot_countries, plot_data, self._figures)
 
 
+    @tracing.traced
     def _launchCard(self, countries, choices) :
         '''Display general info for individual countries'''
-        selected_countries = []
-        for choice in choices :
-            name = countries[choice]
-            self._curr.execute('''SELECT C.wflag, C.official, C.population, C.area, CO.name, C.map, C.code
-                                    FROM Countries C, Continents CO
-                                    WHERE C.continent = CO.id AND C.name = ?''', (name, ))
-            flag, official, pop, area, continent, url, code = self._curr.fetchone()
-            caps, langs, currens = self._getMultiples(name)
-            selected_countries.append((name, flag, official, caps, pop, area, langs, currens, continent, url, code))
-
-        CountryCardWindow(self, selected_countries)
-            
-        
-    def _getMultiples(self, name) :
-        cap_set = set()
-        lang_set = set()
-        currens_set = set()
-        set_list = [cap_set, lang_set, currens_set]
-        for result in self._curr.execute('''SELECT CAP.name, L.name, CUR.name
-                    FROM Countries C 
-                    INNER JOIN Count_Lang_Jn CL on C.id = CL.Country
-                    INNER JOIN Languages L on CL.language = L.id
-                    INNER JOIN Count_Cap_Jn CC on C.id = CC.Country
-                    INNER JOIN Capitals CAP on CC.capital = CAP.id
-                    INNER JOIN Count_Curr_Jn CR on C.id = CR.country
-                    INNER JOIN Currencies CUR on CR.currency = CUR.id
-                    WHERE C.name = ?''', (name, )) :
-            for i in range(len(set_list)) :
-                set_list[i].add(result[i])
-        caps = ', '.join(sorted(cap_set))
-        langs = ', '.join(sorted(lang_set))
-        currens = ', '.join(sorted(currens_set))
-        return caps, langs, currens
+        names = [countries[choice] for choice in choices]
+        codes = self._service.codes(names)
+        CountryCardWindow(self, names, codes, self._flag_images)
     
 
     def mainWinClose(self) :
@@ -484,10 +835,86 @@ class MainWindow(tk.Tk) :
         callback function to quit the program and all memory when user clicks 'X'
         '''
         if tkmb.askokcancel('Confirm close', 'Close all windows and quit?', parent = self) :
-            self._conn.close()
+            self._service.close()
             self.destroy()
             self.quit()
 
 
+def checkImports(budget = IMPORT_BUDGET) :
+    '''
+    Import this file in a fresh interpreter with -X importtime
+    Return list of problems: heavy modules imported, or total time over budget
+    '''
+    import subprocess
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import frontend'],
+                            cwd = here, capture_output = True, text = True, check = True)
+    problems = []
+    for line in result.stderr.splitlines() :
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line :
+            continue
+        _, cumulative, name = line.split('|')
+        name = name.strip()
+        if name.split('.')[0] in HEAVY_MODULES :
+            problems.append(f'{name} imported at startup')
+        if name == 'frontend' and int(cumulative) > budget :
+            problems.append(f'frontend took {int(cumulative):,} us to import, budget {budget:,} us')
+    return problems
+
+
+def checkFigures(rounds = 200, warmup = 20, growth = 0.05) :
+    '''
+    Draw charts on pooled figures rounds times with the Agg backend, as 
+    plot windows opening and closing would, after warmup rounds to fill
+    the caches. Return list of problems: peak memory grew by more than 
+    the growth fraction, or pyplot is keeping track of figures
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib._pylab_helpers import Gcf
+    import charts
+    try :
+        import resource
+    except ImportError :     # Windows; only pyplot's figures are checked
+        resource = None
+    
+    figures = FigurePool()
+    names = [f'Country {i}' for i in range(MainWindow.MAX_COUNTRIES)]
+    
+    def draw(n) :
+        for i in range(n) :
+            metric = ['area', 'population', 'density'][i % 3]
+            values = [(i + 1) * (j + 1) * 1000 for j in range(len(names))]
+            fig = figures.acquire()
+            FigureCanvasAgg(fig)    # stands in for the window's Tk canvas
+            charts.drawCharts(fig, metric, names, values)
+            fig.canvas.draw()
+            figures.release(fig)
+    
+    problems = []
+    draw(warmup)
+    before = resource and resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    draw(rounds)
+    if resource :
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if after > before * (1 + growth) :
+            problems.append(f'peak memory grew from {before:,} to {after:,} over {rounds} plots')
+    if Gcf.figs :
+        problems.append(f'pyplot holds {len(Gcf.figs)} figures')
+    return problems
+
+
 if __name__ == '__main__' :
+    if '--check-imports' in sys.argv :
+        problems = checkImports()
+        for problem in problems :
+            print(problem)
+        raise SystemExit(1 if problems else 0)
+    if '--check-figures' in sys.argv :
+        problems = checkFigures()
+        for problem in problems :
+            print(problem)
+        raise SystemExit(1 if problems else 0)
     MainWindow().mainloop()
@@ -0,0 +1,128 @@
+'''
+Tour de World Border Graph
+Authors: Surajit Bose, James Kang
+Copyright © 2023
+
+This project relies on the REST Countries API by Alejandro Matos:
+    - https://restcountries.com/
+    - https://gitlab.com/restcountries/restcountries
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, you can obtain one at https://mozilla.org/MPL/2.0/
+'''
+
+
+from collections import deque
+
+import numpy as np
+
+
+class BorderGraph :
+    '''
+    Read-only graph of land borders, loaded once from the Borders table
+    Stored as compressed sparse rows (CSR): row i is the country with the
+    i-th smallest id, and its neighbors are the rows in
+    targets[offsets[i] : offsets[i + 1]]. Connected landmasses are
+    labelled once in components, so a route between countries on
+    different landmasses is ruled out without a search
+    Methods take and return country ids
+    '''
+    def __init__(self, conn) :
+        self.ids = np.array([cid for (cid,) in
+                             conn.execute('SELECT id FROM Countries ORDER BY id')],
+                            dtype = np.int64)
+        pairs = np.array(conn.execute('SELECT country_1, country_2 FROM Borders').fetchall(),
+                         dtype = np.int64).reshape(-1, 2)
+        ends = np.searchsorted(self.ids, pairs)
+
+        # Each border is stored once, so it goes into the graph both ways
+        sources = np.concatenate([ends[:, 0], ends[:, 1]])
+        targets = np.concatenate([ends[:, 1], ends[:, 0]])
+        order = np.lexsort((targets, sources))
+        self.targets = targets[order].astype(np.int32)
+        self.offsets = np.zeros(len(self.ids) + 1, dtype = np.int64)
+        np.cumsum(np.bincount(sources, minlength = len(self.ids)), out = self.offsets[1:])
+
+        # Searches step one country at a time, which is quicker on lists
+        self._offsets = self.offsets.tolist()
+        self._targets = self.targets.tolist()
+        self._rows = {cid : i for i, cid in enumerate(self.ids.tolist())}
+        self.components = self._label()
+
+
+    def _neighbors(self, row) :
+        return self._targets[self._offsets[row] : self._offsets[row + 1]]
+
+
+    def _label(self) :
+        '''Return landmass number of every row, counting from 0'''
+        components = np.full(len(self.ids), -1, dtype = np.int32)
+        labels = components.tolist()
+        count = 0
+        for start in range(len(labels)) :
+            if labels[start] != -1 :
+                continue
+            labels[start] = count
+            queue = deque([start])
+            while queue :
+                for nxt in self._neighbors(queue.popleft()) :
+                    if labels[nxt] == -1 :
+                        labels[nxt] = count
+                        queue.append(nxt)
+            count += 1
+        components[:] = labels
+        return components
+
+
+    def within(self, cid, hops) :
+        '''
+        Return dict of id to number of land crossings for every country
+        reachable from country cid in at most hops crossings, except cid
+        '''
+        start = self._rows[cid]
+        dist = {start : 0}
+        frontier = [start]
+        for step in range(1, hops + 1) :
+            nxt = []
+            for row in frontier :
+                for other in self._neighbors(row) :
+                    if other not in dist :
+                        dist[other] = step
+                        nxt.append(other)
+            if not nxt :
+                break
+            frontier = nxt
+        del dist[start]
+        ids = self.ids
+        return {int(ids[row]) : step for row, step in dist.items()}
+
+
+    def route(self, origin, destination) :
+        '''
+        Return ids along a shortest overland route from origin to
+        destination, both included, or None if there is none
+        '''
+        start, goal = self._rows[origin], self._rows[destination]
+        if self.components[start] != self.components[goal] :
+            return None
+        parent = {start : None}
+        queue = deque([start])
+        while goal not in parent :
+            row = queue.popleft()
+            for other in self._neighbors(row) :
+                if other not in parent :
+                    parent[other] = row
+                    queue.append(other)
+        path = []
+        row = goal
+        while row is not None :
+            path.append(int(self.ids[row]))
+            row = parent[row]
+        return path[::-1]
+
+
+    def landmass(self, cid) :
+        '''Return ids of every country on the same landmass as cid, cid included'''
+        label = self.components[self._rows[cid]]
+        return self.ids[self.components == label]
@@ -0,0 +1,129 @@
+'''
+Tour de World Batch Reports
+Authors: Surajit Bose, James Kang
+Copyright © 2023
+
+This project relies on the REST Countries API by Alejandro Matos:
+    - https://restcountries.com/
+    - https://gitlab.com/restcountries/restcountries
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, you can obtain one at https://mozilla.org/MPL/2.0/
+'''
+
+
+import argparse
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import tracing
+from service import DATABASE, CountriesService
+from store import METRICS
+
+REPORT_DIR = 'reports'
+FORMATS = ['png', 'svg']
+TOP = 12        # countries per chart, as many as the plot window allows
+LAYOUT = 1      # bump when the chart layout changes, so every chart is redrawn
+
+# Names of files written here: region, metric, data hash, format
+REPORT_NAME = re.compile(r'[a-z-]+-(?:area|population|density)-[0-9a-f]{16}\.(\w+)')
+
+
+def gather(path = DATABASE, top = TOP) :
+    '''
+    Return (continent, metric, names, values) for the top countries of
+    every continent and metric, worldwide first with continent None
+    '''
+    svc = CountriesService(path, readonly = True)
+    try :
+        jobs = []
+        for continent in [None, *svc.continents()] :
+            for metric in METRICS :
+                # Countries with no land area have no density to chart
+                found = [(name, value) for name, value in svc.top(metric, top, continent)
+                         if value is not None]
+                if found :
+                    names, values = zip(*found)
+                    jobs.append((continent, metric, list(names), list(values)))
+        return jobs
+    finally :
+        svc.close()
+
+
+def fileName(job, fmt) :
+    '''Return file name for a chart, keyed by a hash of what it shows'''
+    continent, metric, _, _ = job
+    key = hashlib.sha256(json.dumps([LAYOUT, fmt, *job]).encode()).hexdigest()[:16]
+    region = (continent or 'worldwide').lower().replace(' ', '-')
+    return f'{region}-{metric}-{key}.{fmt}'
+
+
+def render(job, path) :
+    '''Draw one chart to path with the Agg backend; runs in a worker process'''
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    import charts
+    continent, metric, names, values = job
+    fig = Figure()
+    title, _, _ = charts.labels(metric)
+    fig.suptitle(f'{title} of the {len(names)} Largest, {continent or "Worldwide"}',
+                 fontsize = 11, weight = 'bold')
+    charts.drawCharts(fig, metric, names, values)
+    # Written whole or not at all, so a chart that exists is never half drawn
+    fmt = path.rsplit('.', 1)[1]
+    fig.savefig(path + '.part', format = fmt)
+    os.replace(path + '.part', path)
+
+
+def renderReports(path = DATABASE, out = REPORT_DIR, formats = FORMATS,
+                  top = TOP, workers = None) :
+    '''
+    Render charts of the top countries by each metric for every
+    continent and worldwide, spread over a pool of worker processes
+    Charts whose file already exists are skipped, as the file name holds a
+    hash of the data, and charts of data that has changed are removed
+    Return (number rendered, number skipped)
+    '''
+    os.makedirs(out, exist_ok = True)
+    keep = set()
+    todo = []
+    for job in gather(path, top) :
+        for fmt in formats :
+            name = fileName(job, fmt)
+            keep.add(name)
+            if not os.path.exists(os.path.join(out, name)) :
+                todo.append((job, os.path.join(out, name)))
+
+    if todo :
+        with tracing.span('renderReports', __name__, charts = len(todo)) :
+            # Workers trace nothing, so they don't overwrite this trace on exit
+            with ProcessPoolExecutor(workers, initializer = tracing.disable) as pool :
+                list(pool.map(render, *zip(*todo)))
+
+    for name in os.listdir(out) :
+        match = REPORT_NAME.fullmatch(name)
+        if match and match[1] in formats and name not in keep :
+            os.remove(os.path.join(out, name))
+    return len(todo), len(keep) - len(todo)
+
+
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser(description = 'Render charts for every continent and metric')
+    parser.add_argument('--db', default = DATABASE)
+    parser.add_argument('--out', default = REPORT_DIR, help = 'directory for the charts')
+    parser.add_argument('--format', nargs = '+', choices = ['png', 'svg', 'pdf'],
+                        default = FORMATS, dest = 'formats')
+    parser.add_argument('--top', type = int, default = TOP, help = 'countries per chart')
+    parser.add_argument('--workers', type = int, help = 'processes; default one per CPU')
+    parser.add_argument('--trace', metavar = 'FILE',
+                        help = f'write a Chrome trace to FILE; also set by ${tracing.ENV}')
+    args = parser.parse_args()
+    if args.trace :
+        tracing.enable(args.trace)
+    rendered, skipped = renderReports(args.db, args.out, args.formats, args.top, args.workers)
+    print(f'{rendered} charts rendered, {skipped} unchanged, in {args.out}')
@@ -0,0 +1,471 @@
+'''
+Tour de World HTTP Server
+Authors: Surajit Bose, James Kang
+Copyright © 2023
+
+This project relies on the REST Countries API by Alejandro Matos:
+    - https://restcountries.com/
+    - https://gitlab.com/restcountries/restcountries
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, you can obtain one at https://mozilla.org/MPL/2.0/
+'''
+
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import sys
+import tempfile
+import tracing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
+
+from service import DATABASE, CountriesService
+from store import METRICS
+
+HOST = '127.0.0.1'
+PORT = 8041
+WORKERS = 4         # threads running queries, each with its own connection
+CACHE_SIZE = 1024   # responses kept in memory, least recently used dropped first
+
+JSON = 'application/json'
+PNG = 'image/png'
+REASONS = {200 : 'OK', 304 : 'Not Modified', 400 : 'Bad Request',
+           404 : 'Not Found', 405 : 'Method Not Allowed', 
+           500 : 'Internal Server Error'}
+
+# Card fields in the order CountriesService.cards returns them; the flag
+# thumbnail is left out, as /flags/<code> serves the image
+CARD_FIELDS = [None, 'official', 'capitals', 'population', 'area',
+               'languages', 'currencies', 'continent', 'map', 'code']
+
+USAGE = '''GET /continents
+GET /countries[?continent=]
+GET /ranked/<area|population|density>[?continent=]
+GET /languages
+GET /languages/<language>
+GET /cards?name=<country>[&name=...]
+GET /flags/<code>'''
+
+
+def respond(svc, path, query) :
+    '''
+    Answer a request for path with parse_qs query from svc
+    Return (content type, body). Raise KeyError for anything unknown
+    and ValueError for a malformed request
+    The service memoizes every query it runs until the DB is rebuilt, so
+    names from the client are checked against known ones before any 
+    memoized query, or clients could grow the memo without limit
+    '''
+    parts = [unquote(part) for part in path.strip('/').split('/')]
+    continent = query.get('continent', [None])[0]
+    if continent is not None and continent not in svc.continents() :
+        raise KeyError(continent)
+
+    if parts == ['continents'] :
+        data = svc.continents()
+    elif parts == ['countries'] :
+        data = svc.countries(continent)
+    elif len(parts) == 2 and parts[0] == 'ranked' :
+        if parts[1] not in METRICS :
+            raise KeyError(parts[1])
+        data = {'total' : svc.total(parts[1], continent),
+                'countries' : svc.ranked(parts[1], continent)}
+    elif parts == ['languages'] :
+        data = svc.languages()
+    elif len(parts) == 2 and parts[0] == 'languages' :
+        if parts[1] not in svc.languages() :
+            raise KeyError(parts[1])
+        data = [{'flag' : flag, 'name' : name} 
+                for flag, name in svc.languageCountries(parts[1])]
+    elif parts == ['cards'] :
+        names = query.get('name')
+        if not names :
+            raise ValueError('no name given')
+        data = {name : {field : value for field, value in zip(CARD_FIELDS, card) if field}
+                for name, card in svc.cards(names).items()}
+        for card in data.values() :
+            card['flag'] = f'/flags/{card["code"]}'
+    elif len(parts) == 2 and parts[0] == 'flags' :
+        image = svc.flag(parts[1])
+        if image is None :
+            raise KeyError(parts[1])
+        return PNG, image
+    else :
+        raise KeyError(path)
+    return JSON, json.dumps(data, ensure_ascii = False).encode()
+
+
+class ServicePool :
+    '''
+    Read-only CountriesServices, each used by one worker thread at a time
+    Services opened before the latest rebuild are reopened when next taken
+    '''
+    def __init__(self, path, size) :
+        self._free = queue.SimpleQueue()
+        self._opened = {}
+        self.generation = 0
+        for _ in range(size) :
+            svc = CountriesService(path, readonly = True)
+            self._opened[svc] = self.generation
+            self._free.put(svc)
+
+
+    def take(self) :
+        '''Return a free service connected to the current DB'''
+        svc = self._free.get()
+        if self._opened[svc] != self.generation :
+            svc.close()
+            svc.reopen()
+            self._opened[svc] = self.generation
+        return svc
+
+
+    def give(self, svc) :
+        self._free.put(svc)
+
+
+    def close(self) :
+        for svc in self._opened :
+            svc.close()
+
+
+class CountriesServer :
+    '''
+    Serves the queries behind the front end as JSON over HTTP/1.1
+    The event loop parses requests and answers from an in-memory cache of
+    responses. Misses run on a pool of worker threads with read-only
+    connections, and concurrent requests for the same URL share one query.
+    Every response carries an ETag, so clients revalidating with
+    If-None-Match get 304 Not Modified and no body
+    The cache is dropped whenever the DB file is replaced by a rebuild
+    '''
+    def __init__(self, path = DATABASE, workers = WORKERS, cache_size = CACHE_SIZE) :
+        self._path = path
+        self._pool = ServicePool(path, workers)
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix = 'query')
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._pending = {}
+        self._signature = self._stat()
+
+
+    def _stat(self) :
+        '''Return what identifies the DB file, which a rebuild changes'''
+        st = os.stat(self._path)
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+    def invalidate(self) :
+        '''Drop cached responses and reopen connections on the DB now in place'''
+        self._pool.generation += 1
+        self._cache.clear()
+
+
+    def _checkRebuild(self) :
+        '''Invalidate if the DB file has been swapped since last checked'''
+        try :
+            signature = self._stat()
+        except FileNotFoundError :
+            return
+        if signature != self._signature :
+            self._signature = signature
+            self.invalidate()
+
+
+    @tracing.traced
+    def _answer(self, target) :
+        '''Run on a worker thread: return (status, content type, body, etag)'''
+        split = urlsplit(target)
+        svc = self._pool.take()
+        try :
+            ctype, body = respond(svc, split.path, parse_qs(split.query))
+            status = 200
+        except KeyError :
+            status, ctype, body = 404, JSON, b'{"error": "not found"}'
+        except ValueError as e :
+            status, ctype, body = 400, JSON, json.dumps({'error' : str(e)}).encode()
+        except Exception as e :
+            # Anything else is the server's fault; the client still gets an answer
+            print(f'Error answering {target}: {e!r}', file = sys.stderr)
+            status, ctype, body = 500, JSON, b'{"error": "internal error"}'
+        finally :
+            self._pool.give(svc)
+        etag = '"' + hashlib.blake2b(body, digest_size = 12).hexdigest() + '"'
+        return status, ctype, body, etag
+
+
+    async def lookup(self, target) :
+        '''Return (status, content type, body, etag) for target, cached if possible'''
+        self._checkRebuild()
+        entry = self._cache.get(target)
+        if entry is not None :
+            self._cache.move_to_end(target)
+            return entry
+        generation = self._pool.generation
+        key = generation, target
+        if key in self._pending :
+            return await asyncio.shield(self._pending[key])
+
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self._answer, target)
+        self._pending[key] = future
+        try :
+            entry = await asyncio.shield(future)
+        finally :
+            del self._pending[key]
+        # A response begun before a rebuild must not outlive it
+        if entry[0] == 200 and generation == self._pool.generation :
+            self._cache[target] = entry
+            if len(self._cache) > self._cache_size :
+                self._cache.popitem(last = False)
+        return entry
+
+
+    async def _handle(self, reader, writer) :
+        '''Serve requests on one connection until the client is done'''
+        try :
+            while True :
+                request = await readRequest(reader)
+                if request is None :
+                    break
+                method, target, version, headers = request
+                if method not in ('GET', 'HEAD') :
+                    status, ctype, body, etag = 405, JSON, b'{"error": "GET only"}', None
+                else :
+                    status, ctype, body, etag = await self.lookup(target)
+                    if status == 200 and etag in matches(headers.get('if-none-match')) :
+                        status, body = 304, b''
+                close = (headers.get('connection', '').lower() == 'close'
+                         or version == 'HTTP/1.0')
+                writer.write(responseHead(status, ctype, len(body), etag, close))
+                if method != 'HEAD' :
+                    writer.write(body)
+                await writer.drain()
+                if close :
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) :
+            pass
+        finally :
+            writer.close()
+
+
+    async def start(self, host = HOST, port = PORT) :
+        '''Start listening; return the asyncio server'''
+        return await asyncio.start_server(self._handle, host, port)
+
+
+    async def refreshing(self, refresh) :
+        '''Run refresh on its own thread, and invalidate if it built a new DB'''
+        try :
+            built = await asyncio.to_thread(refresh)
+        except Exception as e :
+            print(f'Could not refresh {self._path}: {e}', file = sys.stderr)
+            return
+        # A refresh that found nothing new may still swap in a copy of the
+        # DB stamped with the time of the check; it has the same data
+        self._signature = self._stat()
+        if built :
+            self.invalidate()
+
+
+    def close(self) :
+        self._executor.shutdown()
+        self._pool.close()
+
+
+async def readRequest(reader) :
+    '''
+    Read one request; return (method, target, version, headers), with
+    header names lowercased, or None when the client has closed
+    Any body is read and discarded
+    '''
+    line = await reader.readline()
+    if not line.strip() :
+        return None
+    method, target, version = line.decode('latin-1').split()
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b'\n', b'') :
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if 'content-length' in headers :
+        await reader.readexactly(int(headers['content-length']))
+    return method, target, version, headers
+
+
+def matches(header) :
+    '''Return the ETags listed in an If-None-Match header'''
+    if not header :
+        return ()
+    return [tag.strip().removeprefix('W/') for tag in header.split(',')]
+
+
+def responseHead(status, ctype, length, etag, close) :
+    '''Return status line and headers of a response'''
+    lines = [f'HTTP/1.1 {status} {REASONS[status]}',
+             f'Content-Type: {ctype}; charset=utf-8' if ctype == JSON else f'Content-Type: {ctype}',
+             f'Content-Length: {length}',
+             # Clients may keep responses, but must revalidate before use
+             'Cache-Control: no-cache']
+    if etag :
+        lines.append(f'ETag: {etag}')
+    if close :
+        lines.append('Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+async def serve(path = DATABASE, host = HOST, port = PORT, refresh = None) :
+    '''Serve the DB at path until cancelled, refreshing it behind the scenes if given refresh'''
+    server = CountriesServer(path)
+    listener = await server.start(host, port)
+    print(f'Serving {path} on http://{host}:{listener.sockets[0].getsockname()[1]}/')
+    print(USAGE)
+    if refresh :
+        # The loop holds tasks only weakly, so keep this one
+        task = asyncio.create_task(server.refreshing(refresh))
+    try :
+        async with listener :
+            await listener.serve_forever()
+    finally :
+        server.close()
+
+
+async def get(reader, writer, target, headers = None) :
+    '''Client side: send GET target on a kept-alive connection; return (status, headers, body)'''
+    extra = ''.join(f'{name}: {value}\r\n' for name, value in (headers or {}).items())
+    writer.write(f'GET {target} HTTP/1.1\r\nHost: {HOST}\r\n{extra}\r\n'.encode('latin-1'))
+    await writer.drain()
+    line = await reader.readline()
+    if not line :
+        raise ConnectionError(f'connection closed before answering {target}')
+    status = int(line.split()[1])
+    found = {}
+    while (line := await reader.readline()) != b'\r\n' :
+        name, _, value = line.decode('latin-1').partition(':')
+        found[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(found['content-length']))
+    return status, found, body
+
+
+async def check(path = DATABASE, clients = 32, rounds = 3) :
+    '''
+    Start a server on a free port and hit it with clients concurrent
+    connections, each fetching every endpoint rounds times. Return a
+    list of problems, empty if every response matched the service's own
+    answer and revalidation with ETags gave 304
+    Then check that a query failing on a copy of the DB missing a table
+    gives 500, uncached, and the connection is still usable after it
+    '''
+    svc = CountriesService(path, readonly = True)
+    continent = svc.continents()[0]
+    language = svc.languages()[0]
+    names = svc.countries()[:3]
+    code = svc.codes(names[:1])[0]
+    where = urlencode({'continent' : continent})
+    targets = ['/continents', '/countries', f'/countries?{where}', '/ranked/area',
+               f'/ranked/population?{where}', '/languages', f'/languages/{quote(language)}',
+               '/cards?' + urlencode([('name', name) for name in names]), f'/flags/{code}']
+    expected = {}
+    for target in targets :
+        split = urlsplit(target)
+        expected[target] = respond(svc, split.path, parse_qs(split.query))[1]
+    svc.close()
+
+    server = CountriesServer(path)
+    listener = await server.start(HOST, 0)
+    port = listener.sockets[0].getsockname()[1]
+    problems = []
+
+    async def client() :
+        reader, writer = await asyncio.open_connection(HOST, port)
+        try :
+            for _ in range(rounds) :
+                for target in targets :
+                    status, headers, body = await get(reader, writer, target)
+                    if status != 200 or body != expected[target] :
+                        problems.append(f'{target}: {status}, body differs')
+                        continue
+                    status, _, body = await get(reader, writer, target,
+                                                {'If-None-Match' : headers['etag']})
+                    if status != 304 or body :
+                        problems.append(f'{target}: revalidation gave {status}')
+            for target in ['/nowhere', '/ranked/height', '/languages/Klingon',
+                           '/countries?continent=Atlantis'] :
+                status, _, _ = await get(reader, writer, target)
+                if status != 404 :
+                    problems.append(f'{target}: {status}, not 404')
+        finally :
+            writer.close()
+
+    try :
+        async with listener :
+            await asyncio.gather(*(client() for _ in range(clients)))
+    finally :
+        server.close()
+    problems.extend(await checkErrors(path))
+    return problems
+
+
+async def checkErrors(path) :
+    '''Return problems serving a DB whose Aggregates table is missing'''
+    problems = []
+    with tempfile.TemporaryDirectory() as folder :
+        broken = os.path.join(folder, 'broken.db')
+        source = sqlite3.connect(f'file:{path}?mode=ro', uri = True)
+        copy = sqlite3.connect(broken)
+        source.backup(copy)
+        source.close()
+        copy.execute('DROP TABLE Aggregates')
+        copy.commit()
+        copy.close()
+
+        server = CountriesServer(broken)
+        listener = await server.start(HOST, 0)
+        port = listener.sockets[0].getsockname()[1]
+        try :
+            async with listener :
+                reader, writer = await asyncio.open_connection(HOST, port)
+                try :
+                    # Twice, as an error must not be cached
+                    for _ in range(2) :
+                        status, _, body = await get(reader, writer, '/ranked/area')
+                        if status != 500 or b'error' not in body :
+                            problems.append(f'/ranked/area on broken DB: {status}, not 500')
+                    status, _, _ = await get(reader, writer, '/continents',
+                                             {'Connection' : 'close'})
+                    if status != 200 :
+                        problems.append(f'/continents after a 500: {status}, not 200')
+                    # Wait for the server to close its end, so no handler is left running
+                    await reader.read()
+                except (ConnectionError, asyncio.IncompleteReadError) :
+                    problems.append('broken DB: connection dropped without a response')
+                finally :
+                    writer.close()
+        finally :
+            server.close()
+    return problems
+
+
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser(description = 'Serve countries.db as JSON over HTTP')
+    parser.add_argument('--db', default = DATABASE)
+    parser.add_argument('--host', default = HOST)
+    parser.add_argument('--port', type = int, default = PORT)
+    parser.add_argument('--check', action = 'store_true',
+                        help = 'hit a server on a free port with concurrent local clients')
+    args = parser.parse_args()
+    if args.check :
+        problems = asyncio.run(check(args.db))
+        for problem in sorted(set(problems)) :
+            print(problem)
+        sys.exit(1 if problems else 0)
+    try :
+        asyncio.run(serve(args.db, args.host, args.port))
+    except KeyboardInterrupt :
+        pass
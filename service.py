@@ -0,0 +1,424 @@
+'''
+Tour de World Query Service
+Authors: Surajit Bose, James Kang
+Copyright © 2023
+
+This project relies on the REST Countries API by Alejandro Matos:
+    - https://restcountries.com/
+    - https://gitlab.com/restcountries/restcountries
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, you can obtain one at https://mozilla.org/MPL/2.0/
+'''
+
+
+import re
+import sqlite3
+import tracing
+
+DATABASE = 'countries.db'
+SEARCH_LIMIT = 200 # most search results returned, however many match
+
+# junction table, its column, and lookup table for each multi-valued
+# attribute on a country card, in the order they are shown
+MULTIPLES = [('Count_Cap_Jn', 'capital', 'Capitals'),
+             ('Count_Lang_Jn', 'language', 'Languages'),
+             ('Count_Curr_Jn', 'currency', 'Currencies')]
+
+# Fixed SQL text, so sqlite3's statement cache prepares each query only once
+CONTINENTS = 'SELECT name FROM Continents ORDER BY name'
+LANGUAGES = '''SELECT name FROM Languages
+            WHERE name != 'None' ORDER BY name'''
+LANGUAGE_COUNTRIES = '''SELECT C.mflag, C.name FROM Countries C
+            INNER JOIN Count_Lang_Jn CL on C.id = CL.Country
+            INNER JOIN Languages L on CL.language = L.id
+            WHERE L.name = ? ORDER BY C.name'''
+FLAG = '''SELECT F.image FROM Countries C
+            INNER JOIN Flags F on C.flag = F.id WHERE C.code = ?'''
+
+# Type-ahead search over the FTS5 Search table, whose rowid is the country id
+# CROSS JOIN keeps SQLite from running the MATCH once for every country
+SEARCH = '''SELECT C.name FROM Search S
+            CROSS JOIN Countries C on C.id = S.rowid
+            WHERE Search MATCH ? LIMIT ?'''
+SEARCH_CONTINENT = '''SELECT C.name FROM Search S
+            CROSS JOIN Countries C on C.id = S.rowid
+            WHERE Search MATCH ? 
+            AND C.continent = (SELECT id FROM Continents WHERE name = ?) LIMIT ?'''
+SEARCH_LANGUAGES = '''SELECT DISTINCT L.name FROM Search S
+            CROSS JOIN Count_Lang_Jn CL on CL.country = S.rowid
+            CROSS JOIN Languages L on CL.language = L.id
+            WHERE Search MATCH ?'''
+
+# Statistics precomputed at ingest, in the order of store.STATS
+# Continent 0 holds the worldwide figures
+AGGREGATE_STATS = ['count', 'sum', 'min', 'q1', 'median', 'q3', 'max']
+AGGREGATES = f'''SELECT {', '.join(AGGREGATE_STATS)} FROM Aggregates
+            WHERE metric = ? AND continent = 
+            COALESCE((SELECT id FROM Continents WHERE name = ?), 0)'''
+
+
+def matchQuery(text, column = None) :
+    '''
+    FTS5 query for rows with a word starting with each word of text,
+    in column if given, or None if text has no words
+    '''
+    words = re.findall(r'\w+', text)
+    if not words :
+        return None
+    query = ' '.join(f'"{word}"*' for word in words)
+    return f'{column} : ({query})' if column else query
+
+
+def startsWords(text, name) :
+    '''Return whether each word of text starts some word of name'''
+    words = re.findall(r'\w+', name.casefold())
+    return all(any(word.startswith(part) for word in words)
+               for part in re.findall(r'\w+', text.casefold()))
+
+
+def cardQuery(count) :
+    '''SQL for the single-valued card details of count countries'''
+    marks = ', '.join('?' * count)
+    return f'''SELECT C.name, F.thumb, C.official, C.population, C.area,
+            CO.name, C.map, C.code FROM Countries C, Continents CO, Flags F
+            WHERE C.continent = CO.id AND C.flag = F.id AND C.name IN ({marks})'''
+
+
+def multiplesQuery(count) :
+    '''
+    SQL for capitals, languages, and currencies of count countries
+    One UNION ALL statement with a branch per attribute, so rows grow
+    with the sum of the attribute counts rather than their product
+    '''
+    marks = ', '.join('?' * count)
+    return ' UNION ALL '.join(f'''SELECT {i}, C.name, T.name FROM Countries C
+            INNER JOIN {junction} J on C.id = J.country
+            INNER JOIN {table} T on J.{col} = T.id
+            WHERE C.name IN ({marks})'''
+            for i, (junction, col, table) in enumerate(MULTIPLES))
+
+
+class CountriesService :
+    '''
+    Every query Tour de World knows, with no GUI attached
+    Results are memoized until another connection commits to the DB,
+    which PRAGMA data_version reports. Country lists and rankings come from
+    store.CountryStore, and border searches from graph.BorderGraph, each
+    imported and loaded only when first needed
+    A service and its connection belong to the thread that created them,
+    except loadStore and loadGraph, which open connections of their own
+    A readonly service never writes to the DB, and may be handed from one
+    thread to another as long as only one uses it at a time
+    '''
+    def __init__(self, path = DATABASE, readonly = False) :
+        self._path = path
+        self._readonly = readonly
+        self._memo = {}
+        self._cards = {}
+        self.reopen()
+
+
+    def reopen(self) :
+        '''
+        Connect to the DB again, dropping everything read from it before
+        Needed after a new DB is swapped in, as the old connection keeps 
+        reading the file that was replaced
+        '''
+        self._conn = self._connect(cached_statements = 256)
+        tracing.watch(self._conn)
+        self._version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        self.clear()
+        self._store = None
+        self._graph = None
+
+
+    def _connect(self, **kwargs) :
+        '''Open a connection to the DB, read-only if the service is'''
+        if self._readonly :
+            return sqlite3.connect(f'file:{self._path}?mode=ro', uri = True,
+                                   check_same_thread = False, **kwargs)
+        return sqlite3.connect(self._path, **kwargs)
+
+
+    def close(self) :
+        self._conn.close()
+
+
+    def _fresh(self) :
+        '''Drop memoized results if the DB has changed since they were made'''
+        version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        if version != self._version :
+            self._version = version
+            self.clear()
+            self._store = None
+            self._graph = None
+
+
+    def clear(self) :
+        '''Drop memoized query results, keeping the country store'''
+        self._memo.clear()
+        self._cards.clear()
+
+
+    def _memoized(self, key, compute) :
+        '''Return memoized result for key, computing it if needed'''
+        self._fresh()
+        try :
+            return self._memo[key]
+        except KeyError :
+            self._memo[key] = compute()
+            return self._memo[key]
+
+
+    @tracing.traced
+    def loadStore(self) :
+        '''Load the country store; safe to call from a worker thread'''
+        from store import CountryStore
+        conn = self._connect()
+        try :
+            self._store = CountryStore(conn)
+        finally :
+            conn.close()
+
+
+    @property
+    def store(self) :
+        '''Country store, loaded on first use'''
+        self._fresh()
+        if self._store is None :
+            self.loadStore()
+        return self._store
+
+
+    @tracing.traced
+    def loadGraph(self) :
+        '''Load the border graph; safe to call from a worker thread'''
+        from graph import BorderGraph
+        conn = self._connect()
+        try :
+            self._graph = BorderGraph(conn)
+        finally :
+            conn.close()
+
+
+    @property
+    def graph(self) :
+        '''Border graph, loaded on first use'''
+        self._fresh()
+        if self._graph is None :
+            self.loadGraph()
+        return self._graph
+
+
+    def _names(self, ids) :
+        '''Return names of the countries with the given ids'''
+        store = self.store
+        return store.names[store.idRows(ids)].tolist()
+
+
+    def _id(self, name) :
+        '''Return id of the named country'''
+        store = self.store
+        return int(store.ids[store.rows([name])[0]])
+
+
+    @tracing.traced
+    def continents(self) :
+        '''Return continent names, sorted'''
+        return self._memoized('continents', lambda :
+            tuple(name for (name,) in self._conn.execute(CONTINENTS)))
+
+
+    @tracing.traced
+    def countries(self, continent = None) :
+        '''Return names of countries in continent, or worldwide, sorted'''
+        def compute() :
+            store = self.store
+            return tuple(store.names[store.alphabetical(continent)].tolist())
+        return self._memoized(('countries', continent), compute)
+
+
+    @tracing.traced
+    def ranked(self, metric, continent = None) :
+        '''
+        Return (name, value) for countries in continent, or worldwide,
+        largest area, population, or density first
+        '''
+        def compute() :
+            store = self.store
+            rows = store.ranked(metric, continent)
+            return tuple(zip(store.names[rows].tolist(), store.values(metric, rows)))
+        return self._memoized(('ranked', metric, continent), compute)
+
+
+    @tracing.traced
+    def top(self, metric, k, continent = None) :
+        '''Return (name, value) for the k countries in continent, or worldwide, with the largest metric'''
+        def compute() :
+            store = self.store
+            rows = store.top(metric, k, continent)
+            return tuple(zip(store.names[rows].tolist(), store.values(metric, rows)))
+        return self._memoized(('top', metric, k, continent), compute)
+
+
+    def metrics(self, names) :
+        '''Return dict of metric to the values of the named countries, in order'''
+        store = self.store
+        rows = store.rows(names)
+        return {metric : store.values(metric, rows) for metric in store.columns}
+
+
+    def order(self, names, key = 'name', percentile = False) :
+        '''
+        Return indices into names sorted alphabetically, or by area, 
+        population, or density, largest first. With percentile, sort by
+        where each country stands within its own continent instead
+        '''
+        store = self.store
+        return store.order(store.rows(names), key, percentile).tolist()
+
+
+    @tracing.traced
+    def aggregates(self, metric, continent = None) :
+        '''
+        Return dict of count, sum, min, quartiles, and max of area, 
+        population, or density in continent, or worldwide, from the
+        Aggregates table the backend fills. A continent with no countries
+        has count and sum 0
+        '''
+        def compute() :
+            row = self._conn.execute(AGGREGATES, (metric, continent)).fetchone()
+            if row is None :
+                from store import describe
+                return describe([])
+            return dict(zip(AGGREGATE_STATS, row))
+        return self._memoized(('aggregates', metric, continent), compute)
+
+
+    def total(self, metric, continent = None) :
+        '''Return total area or population of continent, or worldwide'''
+        return self.aggregates(metric, continent)['sum']
+
+
+    def codes(self, names) :
+        '''Return three-letter codes of the named countries'''
+        store = self.store
+        return store.codes[store.rows(names)].tolist()
+
+
+    @tracing.traced
+    def neighbors(self, name, hops = 1) :
+        '''
+        Return (name, land crossings) for every country within hops
+        crossings of the named one, nearest first, then alphabetically
+        '''
+        def compute() :
+            found = self.graph.within(self._id(name), hops)
+            pairs = zip(self._names(list(found)), found.values())
+            return tuple(sorted(pairs, key = lambda pair : (pair[1], pair[0])))
+        return self._memoized(('neighbors', name, hops), compute)
+
+
+    @tracing.traced
+    def route(self, origin, destination) :
+        '''
+        Return names of countries along a shortest overland route,
+        both ends included, or None if there is no overland route
+        '''
+        def compute() :
+            path = self.graph.route(self._id(origin), self._id(destination))
+            return None if path is None else tuple(self._names(path))
+        return self._memoized(('route', origin, destination), compute)
+
+
+    @tracing.traced
+    def landmass(self, name) :
+        '''Return names of countries reachable overland from the named one, sorted'''
+        return self._memoized(('landmass', name), lambda :
+            tuple(sorted(self._names(self.graph.landmass(self._id(name)).tolist()))))
+
+
+    @tracing.traced
+    def languages(self) :
+        '''Return names of all official languages, sorted'''
+        return self._memoized('languages', lambda :
+            tuple(name for (name,) in self._conn.execute(LANGUAGES)))
+
+
+    @tracing.traced
+    def languageCountries(self, language) :
+        '''Return (emoji flag, name) of countries where language is official'''
+        return self._memoized(('language', language), lambda :
+            tuple(self._conn.execute(LANGUAGE_COUNTRIES, (language,))))
+
+
+    @tracing.traced
+    def flag(self, code) :
+        '''Return PNG flag image of the country with three-letter code, or None'''
+        row = self._conn.execute(FLAG, (code,)).fetchone()
+        return row and row[0]
+
+
+    @tracing.traced
+    def search(self, text, continent = None, limit = SEARCH_LIMIT) :
+        '''
+        Return names of up to limit countries in continent, or worldwide,
+        whose names, capitals, languages, or currencies have words starting
+        with each word of text
+        '''
+        query = matchQuery(text)
+        if query is None :
+            return ()
+        if continent is None :
+            rows = self._conn.execute(SEARCH, (query, limit))
+        else :
+            rows = self._conn.execute(SEARCH_CONTINENT, (query, continent, limit))
+        return tuple(name for (name,) in rows)
+
+
+    @tracing.traced
+    def searchLanguages(self, text, limit = SEARCH_LIMIT) :
+        '''Return up to limit official languages with words starting with each word of text'''
+        query = matchQuery(text, 'languages')
+        if query is None :
+            return ()
+        # Countries with a matching language can have other languages too
+        found = []
+        for (name,) in self._conn.execute(SEARCH_LANGUAGES, (query,)) :
+            if startsWords(text, name) :
+                found.append(name)
+                if len(found) == limit :
+                    break
+        return tuple(found)
+
+
+    @tracing.traced
+    def cards(self, names) :
+        '''
+        Return dict of name to (flag thumbnail, official name, capitals,
+        population, area, languages, currencies, continent, map url, code)
+        Countries not already memoized are fetched with two statements
+        '''
+        self._fresh()
+        missing = [name for name in names if name not in self._cards]
+        if missing :
+            self._cards.update(self._fetchCards(missing))
+        return {name : self._cards[name] for name in names}
+
+
+    def _fetchCards(self, names) :
+        '''Fetch card data for the named countries'''
+        details = {row[0] : row[1:] for row in
+                   self._conn.execute(cardQuery(len(names)), names)}
+        found = {name : [set() for _ in MULTIPLES] for name in names}
+        for i, name, item in self._conn.execute(multiplesQuery(len(names)),
+                                                names * len(MULTIPLES)) :
+            found[name][i].add(item)
+        cards = {}
+        for name in names :
+            flag, official, pop, area, continent, url, code = details[name]
+            caps, langs, currens = (', '.join(sorted(items)) for items in found[name])
+            cards[name] = (flag, official, caps, pop, area, langs, currens, continent, url, code)
+        return cards
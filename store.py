@@ -0,0 +1,195 @@
+'''
+Tour de World Country Store
+Authors: Surajit Bose, James Kang
+Copyright © 2023
+
+This project relies on the REST Countries API by Alejandro Matos:
+    - https://restcountries.com/
+    - https://gitlab.com/restcountries/restcountries
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, you can obtain one at https://mozilla.org/MPL/2.0/
+'''
+
+
+import numpy as np
+
+METRICS = ['area', 'population', 'density']
+
+# Statistics returned by describe, in the order the Aggregates table holds them
+STATS = ['count', 'sum', 'min', 'q1', 'median', 'q3', 'max']
+
+
+class CountryStore :
+    '''
+    Read-only columnar copy of the Countries table, loaded once
+    Rows are kept in alphabetical order, so row index i is the i-th country
+    by name. Density, people per km², is derived from the other columns,
+    NaN where a country has no land area. Each metric is ranked worldwide 
+    and within every continent the first time it is asked for, so listing 
+    and sorting are array slices after that
+    '''
+    def __init__(self, conn) :
+        rows = conn.execute('''SELECT name, code, continent, area, population, id
+                            FROM Countries ORDER BY name''').fetchall()
+        names, codes, conts, areas, pops, ids = zip(*rows) if rows else ([],) * 6
+        self.names = np.array(names, dtype = str)
+        self.ids = np.array(ids, dtype = np.int64)
+        self.codes = np.array(codes, dtype = str)
+        self.continents = np.array(conts, dtype = np.int32)
+        area = np.array(areas, dtype = np.float64)
+        pop = np.array(pops, dtype = np.int64)
+        density = np.full(len(area), np.nan)
+        np.divide(pop, area, out = density, where = area > 0)
+        self.columns = {'area' : area, 'population' : pop, 'density' : density}
+        self._rows = {name : i for i, name in enumerate(names)}
+        self._id_rows = {cid : i for i, cid in enumerate(ids)}
+
+        # Ids in the Continents table, keyed by continent name
+        self.continent_ids = {name : cid for cid, name in
+                              conn.execute('SELECT id, name FROM Continents')}
+
+        # Row indices per continent, None meaning worldwide
+        everyone = np.arange(len(self.names))
+        self._members = {None : everyone}
+        for cid in self.continent_ids.values() :
+            self._members[cid] = np.flatnonzero(self.continents == cid)
+
+        # Filled in by _rank, one metric at a time
+        self._ranked = {}
+        self._percentiles = {}
+
+
+    def _key(self, metric, rows = None) :
+        '''Return sort key putting largest metric first and NaN last'''
+        column = self.columns[metric] if rows is None else self.columns[metric][rows]
+        return np.where(np.isnan(column), np.inf, -column)
+
+
+    def _rank(self, metric) :
+        '''
+        Rank every country by metric, worldwide and within its continent
+        One stable sort by continent, then largest first, orders every 
+        continent at once, keeping ties in alphabetical order. Each 
+        country's percentile in its continent comes from its position in
+        that order, among the countries whose metric is not NaN, which
+        sort last
+        '''
+        if metric in self._percentiles :
+            return
+        key = self._key(metric)
+        self._ranked[None, metric] = np.argsort(key, kind = 'stable')
+        order = np.lexsort((key, self.continents))
+        groups = self.continents[order]
+        starts = np.searchsorted(groups, groups, side = 'left')
+        ends = np.searchsorted(groups, groups, side = 'right')
+        position = np.arange(len(order)) - starts
+        # Countries in each one's continent with a metric to compare
+        found = np.concatenate([[0], np.cumsum(~np.isnan(self.columns[metric][order]))])
+        sizes = found[ends] - found[starts]
+        for cid in self.continent_ids.values() :
+            lo, hi = np.searchsorted(groups, [cid, cid + 1])
+            self._ranked[cid, metric] = order[lo : hi]
+
+        # Percentile 100 is the largest, 0 the smallest
+        percentiles = np.empty(len(order))
+        percentiles[order] = np.where(sizes > 1, 100 * (sizes - 1 - position) 
+                                      / np.maximum(sizes - 1, 1), 100.0)
+        percentiles[np.isnan(self.columns[metric])] = np.nan
+        self._percentiles[metric] = percentiles
+
+
+    def alphabetical(self, continent = None) :
+        '''Return row indices of countries in continent, sorted by name'''
+        return self._members[self.continent_ids.get(continent)]
+
+
+    def ranked(self, metric, continent = None) :
+        '''Return row indices of countries in continent, largest metric first'''
+        self._rank(metric)
+        return self._ranked[self.continent_ids.get(continent), metric]
+
+
+    def percentiles(self, metric) :
+        '''
+        Return percentile of every row in its continent by metric: 100 for
+        the largest, 0 for the smallest, NaN where metric is NaN
+        '''
+        self._rank(metric)
+        return self._percentiles[metric]
+
+
+    def top(self, metric, k, continent = None) :
+        '''
+        Return row indices of the k countries in continent with the largest
+        metric, largest first; the same as ranked(metric, continent)[:k],
+        but found with np.argpartition, without ranking the rest
+        '''
+        members = self._members[self.continent_ids.get(continent)]
+        if k >= len(members) :
+            return self.ranked(metric, continent)
+        if k <= 0 :
+            return members[:0]
+        key = self._key(metric, members)
+        edge = key[np.argpartition(key, k - 1)[:k]].max()
+        # Ties at the edge go to the first alphabetically, as in ranked
+        inside = np.flatnonzero(key < edge)
+        ties = np.flatnonzero(key == edge)[: k - len(inside)]
+        chosen = np.concatenate([inside, ties])
+        return members[chosen[np.lexsort((chosen, key[chosen]))]]
+
+
+    def order(self, rows, key = 'name', percentile = False) :
+        '''
+        Return positions in rows sorted by key: alphabetically for 'name',
+        otherwise largest metric first, or with percentile, highest 
+        percentile in their own continents first. NaN goes last and ties
+        stay alphabetical
+        '''
+        rows = np.asarray(rows, dtype = np.int64)
+        if key == 'name' :
+            return np.argsort(rows, kind = 'stable')
+        values = self.percentiles(key)[rows] if percentile else self.columns[key][rows]
+        return np.lexsort((rows, np.where(np.isnan(values), np.inf, -values)))
+
+
+    def rows(self, names) :
+        '''Return row indices for the given country names'''
+        return np.array([self._rows[name] for name in names], dtype = np.int64)
+
+
+    def idRows(self, ids) :
+        '''Return row indices for the given country ids'''
+        return np.array([self._id_rows[cid] for cid in ids], dtype = np.int64)
+
+
+    def values(self, metric, rows) :
+        '''Return metric for the given rows as a list of Python numbers'''
+        return [toPython(value) for value in self.columns[metric][rows]]
+
+
+def toPython(value) :
+    '''Convert NumPy scalar to int or float, as SQLite would return it'''
+    value = value.item()
+    if isinstance(value, float) :
+        if value != value :     # NaN, which SQLite would return as NULL
+            return None
+        if value.is_integer() :
+            return int(value)
+    return value
+
+
+def describe(values) :
+    '''
+    Return dict of count, sum, min, quartiles, and max of values
+    values become one array, and one call to np.quantile finds all five
+    order statistics. Empty values give count and sum 0 and None for the rest
+    '''
+    values = np.asarray(values)
+    if not len(values) :
+        return dict.fromkeys(STATS, None) | {'count' : 0, 'sum' : 0}
+    low, q1, median, q3, high = np.quantile(values, [0, .25, .5, .75, 1])
+    return {'count' : len(values), 'sum' : toPython(values.sum()), 
+            'min' : toPython(low), 'q1' : toPython(q1), 'median' : toPython(median),
+            'q3' : toPython(q3), 'max' : toPython(high)}
@@ -12,9 +12,57 @@ License, v. 2.0. If a copy of the MPL was not distributed with this
 file, you can obtain one at https://mozilla.org/MPL/2.0/
 '''
 
-import backend
-import frontend
+import argparse
+from os.path import exists
+import tracing
+
+# The window's database, also the one served over HTTP
+COUNTRIES_DB = 'countries.db'
+
+
+def refresh() :
+    '''Refresh the DB from the API; return True if a new DB was built'''
+    # Imported here, off the main thread, so the window isn't kept waiting
+    import backend
+    return backend.main()
+
+
+def install() :
+    '''Swap in a new DB that couldn't replace the old one while it was open'''
+    import backend
+    return backend.installBuild(COUNTRIES_DB)
+
+
+def serve(host, port) :
+    '''Serve the DB as JSON over HTTP with no window, refreshing it behind the scenes'''
+    import asyncio
+    import server
+    try :
+        asyncio.run(server.serve(COUNTRIES_DB, host, port, refresh))
+    except KeyboardInterrupt :
+        pass
+
 
 if __name__ == '__main__' :
-    backend.main()
-    frontend.MainWindow().mainloop()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = 'Tour de World')
+    parser.add_argument('--serve', action = 'store_true',
+                        help = 'run headless, serving the data as JSON over HTTP')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8041)
+    parser.add_argument('--trace', metavar = 'FILE', 
+                        help = f'write a Chrome trace of the session to FILE; also set by ${tracing.ENV}')
+    args = parser.parse_args()
+    if args.trace :
+        tracing.enable(args.trace)
+
+    # On the first run there is nothing to show until the DB is built
+    if not exists(COUNTRIES_DB) :
+        refresh()
+    # Otherwise the last good DB is shown while a refresh runs behind it
+    if args.serve :
+        serve(args.host, args.port)
+    else :
+        import frontend
+        window = frontend.MainWindow()
+        window.startRefresh(refresh, install)
+        window.mainloop()
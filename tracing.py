@@ -0,0 +1,201 @@
+'''
+Tour de World Tracing
+Authors: Surajit Bose, James Kang
+Copyright © 2023
+
+This project relies on the REST Countries API by Alejandro Matos:
+    - https://restcountries.com/
+    - https://gitlab.com/restcountries/restcountries
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, you can obtain one at https://mozilla.org/MPL/2.0/
+'''
+
+
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Tracing is on when this names the file to write the trace to
+ENV = 'TOUR_TRACE'
+
+enabled = False
+_path = None
+_events = []
+_threads = {}
+_totals = Counter()
+_lock = threading.Lock()
+_local = threading.local()
+_origin = time.perf_counter_ns()
+
+
+def _stack() :
+    '''Return this thread's open spans, innermost last'''
+    try :
+        return _local.stack
+    except AttributeError :
+        _local.stack = []
+        return _local.stack
+
+
+class Span :
+    '''
+    Timed section of work, with counters of what it did
+    Counters of a span are added to the span enclosing it when it ends
+    '''
+    __slots__ = ('name', 'category', 'args', 'counts', 'start')
+
+    def __init__(self, name, category = '', **args) :
+        self.name = name
+        self.category = category
+        self.args = args
+        self.counts = Counter()
+
+
+    def __enter__(self) :
+        _stack().append(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+
+    def __exit__(self, *exc) :
+        end = time.perf_counter_ns()
+        stack = _stack()
+        stack.pop()
+        if stack :
+            stack[-1].counts.update(self.counts)
+        thread = threading.current_thread()
+        event = {'name' : self.name, 'cat' : self.category, 'ph' : 'X',
+                 'ts' : (self.start - _origin) / 1000, 'dur' : (end - self.start) / 1000,
+                 'pid' : os.getpid(), 'tid' : thread.native_id,
+                 'args' : {**self.args, **self.counts}}
+        with _lock :
+            _events.append(event)
+            _threads[thread.native_id] = thread.name
+
+
+class NoSpan :
+    '''Stands in for Span while tracing is off, doing nothing'''
+    __slots__ = ()
+
+    def __enter__(self) :
+        return self
+
+
+    def __exit__(self, *exc) :
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def span(name, category = '', **args) :
+    '''Return context manager timing a span, or one doing nothing if tracing is off'''
+    if not enabled :
+        return NO_SPAN
+    return Span(name, category, **args)
+
+
+def traced(func) :
+    '''Decorator making every call of func a span named for it'''
+    name = func.__qualname__
+    category = func.__module__
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs) :
+        if not enabled :
+            return func(*args, **kwargs)
+        with Span(name, category) :
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def count(name, n = 1) :
+    '''Add n to counter name of the innermost open span, and to the totals'''
+    if not enabled :
+        return
+    stack = _stack()
+    if stack :
+        stack[-1].counts[name] += n
+    with _lock :
+        _totals[name] += n
+
+
+def _statement(sql) :
+    count('statements')
+
+
+def watch(conn) :
+    '''Count statements run on an sqlite3 connection, if tracing is on'''
+    if enabled :
+        conn.set_trace_callback(_statement)
+
+
+class CountingReader :
+    '''Binary file wrapper counting the bytes read from it'''
+    def __init__(self, file) :
+        self._file = file
+
+
+    def read(self, size = -1) :
+        data = self._file.read(size)
+        count('bytes', len(data))
+        return data
+
+
+def reader(file) :
+    '''Return file, wrapped to count bytes read if tracing is on'''
+    return CountingReader(file) if enabled else file
+
+
+def _writeAtExit() :
+    write(_path)
+
+
+def enable(path) :
+    '''Start tracing; the trace is written to path when the program exits'''
+    global enabled, _path
+    if not enabled :
+        atexit.register(_writeAtExit)
+    enabled = True
+    _path = path
+
+
+def disable() :
+    '''Stop tracing without writing a trace, as in worker processes'''
+    global enabled
+    if enabled :
+        atexit.unregister(_writeAtExit)
+    enabled = False
+
+
+def trace() :
+    '''
+    Return the trace so far as a dict in Chrome trace event format, for
+    chrome://tracing or https://ui.perfetto.dev. Totals of every counter
+    are under otherData
+    '''
+    with _lock :
+        events = list(_events)
+        names = [{'name' : 'thread_name', 'ph' : 'M', 'pid' : os.getpid(),
+                  'tid' : tid, 'args' : {'name' : name}}
+                 for tid, name in _threads.items()]
+        totals = dict(_totals)
+    return {'traceEvents' : names + events, 'displayTimeUnit' : 'ms',
+            'otherData' : {'counters' : totals}}
+
+
+def write(path) :
+    '''Write the trace so far to path as JSON'''
+    with open(path, 'w') as file :
+        json.dump(trace(), file)
+    print(f'Trace written to {path}', file = sys.stderr)
+
+
+if os.environ.get(ENV) :
+    enable(os.environ[ENV])